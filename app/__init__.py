@@ -9,10 +9,18 @@ from flask_apscheduler import APScheduler
 from flask_login import LoginManager
 from flask_migrate import Migrate
 from flask_seeder import FlaskSeeder
+from app.audit import audit_log
 from app.database import db
-from app.form import login_form
+from app.events import publication_feed
+from app.form import login_modal_form
+from app.fragments import fragment_cache
+from app.identities import identity_cache
+from app.leader import acquire_leader_lock
+from app.login_protection import login_rate_limiter, password_verifier
+from app.sessions import sqlite_sessions
 from flask_session import Session
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.exceptions import NotFound
 
 
@@ -26,6 +34,33 @@ seeder = FlaskSeeder()
 scheduler = APScheduler()
 
 
+def start_scheduler(app:Flask) ->bool:
+    """
+    The function `start_scheduler` starts the scheduled tasks only if the current process is elected as
+    leader, so that multiple web server workers on the same host never run `process_models` together.
+    
+    @param app The `app` parameter is the Flask application object.
+
+    @return Returns True if the scheduler is running in the current process, False otherwise.
+    """
+
+    if scheduler.running:
+        return True
+
+    lock_file = path.join(app.instance_path, app.config["SCHEDULER_LOCK_FILE"])
+    if not acquire_leader_lock(lock_file):
+        logging.info(f"Scheduler not started in process {os.getpid()}: another process is the leader")
+        return False
+
+    scheduler.start()
+
+    if app.config.get("INGEST_WATCHER"):
+        from app.scheduled_tasks import start_watcher
+        start_watcher()
+
+    return True
+
+
 def create_app() ->Flask:
     """
     Create and configure the app
@@ -47,6 +82,10 @@ def create_app() ->Flask:
             msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)} | Cannot load config file."
             sys.exit(msg)
 
+        #A misspelled value would send headers that the front proxy ignores, leaking the file paths
+        if app.config["MODELS_SENDFILE"] not in ("", "x-accel-redirect", "x-sendfile"):
+            sys.exit(f"{ __file__} | Invalid MODELS_SENDFILE \"{app.config['MODELS_SENDFILE']}\": use x-accel-redirect, x-sendfile or leave it empty.")
+
         if not app.config.get("APPLICATION_ROOT") == "/":
             app.wsgi_app = DispatcherMiddleware(
                 NotFound(),{
@@ -54,23 +93,42 @@ def create_app() ->Flask:
                 }
             )
 
+        #Behind the front proxy the remote address is the proxy itself: the address of the user, used by the
+        #login rate limits and the audit log, is taken from the X-Forwarded-For set by the trusted proxies only
+        if app.config["TRUSTED_PROXIES"]:
+            app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["TRUSTED_PROXIES"], x_proto=app.config["TRUSTED_PROXIES"])
+
 
         #We need to import all the models to permit the automigrate of the tables with Alembic
         #Add all custom commands
-        from app.commands import add_user
+        from app.commands import add_user, benchmark_descriptors, benchmark_webp, prune_legacy_sessions, run_scheduler
         from app.models import Actions, User_actions, Users
         
         app.cli.add_command(add_user)
+        app.cli.add_command(run_scheduler)
+        app.cli.add_command(benchmark_descriptors)
+        app.cli.add_command(benchmark_webp)
+        app.cli.add_command(prune_legacy_sessions)
    
 
         db.init_app(app)
         migrate.init_app(app, db)
-        sess.init_app(app)
+        if app.config["SESSION_TYPE"] == "sqlite":
+            sqlite_sessions.init_app(app)
+        else:
+            sess.init_app(app)
         seeder.init_app(app, db)
         scheduler.init_app(app)
+        fragment_cache.init_app(app)
+        identity_cache.init_app(app)
+        audit_log.init_app(app)
+        password_verifier.init_app(app)
+        login_rate_limiter.init_app(app)
+        publication_feed.init_app(app)
       
         from . import scheduled_tasks
-        scheduler.start()
+        if app.config.get("SCHEDULER_AUTOSTART"):
+            start_scheduler(app)
            
       
         SCHEMA = app.config.get("PROJECT_NAME")
@@ -96,7 +154,7 @@ def create_app() ->Flask:
 
         @login_manager.user_loader
         def load_user(user_id:str) -> Union[str, None]:
-            return Users.query.get(user_id)
+            return identity_cache.load(user_id)
         
 
         #########################################
@@ -118,7 +176,7 @@ def create_app() ->Flask:
     
             return render_template(
                 '404.html', 
-                form=login_form(), 
+                form=login_modal_form(), 
                 base_href = current_app.config["APPLICATION_ROOT"],
                 display_name=current_app.config["DISPLAY_NAME"],
                 title = "Pagina non trovata"), 404
@@ -143,7 +201,7 @@ def create_app() ->Flask:
 
             return render_template(
                 '403.html', 
-                form=login_form(),
+                form=login_modal_form(),
                 base_href = current_app.config["APPLICATION_ROOT"],
                 display_name=current_app.config["DISPLAY_NAME"],
                 title = "Accesso negato"), 403
@@ -168,7 +226,7 @@ def create_app() ->Flask:
 
             return render_template(
                 '500.html', 
-                form=login_form(), 
+                form=login_modal_form(), 
                 base_href = current_app.config["APPLICATION_ROOT"],
                 display_name=current_app.config["DISPLAY_NAME"], 
                 title = "Errore interno al server"), 500
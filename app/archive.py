@@ -0,0 +1,187 @@
+import logging
+import threading
+import zipfile
+from collections import OrderedDict
+from os import listdir, makedirs, path, remove, replace, stat, walk
+
+
+#Expired runs are packed into .archive/<run>.zip: a single file per run, whose central directory
+#gives random access to every image without extracting it
+ARCHIVE_DIRNAME = ".archive"
+ARCHIVE_HANDLES = 32
+
+
+#Open archives of this process, the central directory is parsed only once per archive
+_archives = OrderedDict()
+_archives_lock = threading.Lock()
+
+
+#########################################
+# ARCHIVE PATH                          #
+#########################################
+def archive_path(models_path:str, run:str) ->str:
+    """
+    The function `archive_path` returns the path of the archive of a run.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param run The `run` parameter is a string that represents the run directory.
+
+    @return The path of the archive.
+    """
+
+    return path.join(models_path, ARCHIVE_DIRNAME, run + ".zip")
+
+
+#########################################
+# LIST ARCHIVED RUNS                    #
+#########################################
+def list_archived_runs(models_path:str) ->list:
+    """
+    The function `list_archived_runs` lists the runs packed into the archive.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+
+    @return The sorted list of the archived run names.
+    """
+
+    archive_dir = path.join(models_path, ARCHIVE_DIRNAME)
+    if not path.isdir(archive_dir):
+        return []
+
+    return sorted( item[:-len(".zip")] for item in listdir(archive_dir) if item.endswith(".zip") )
+
+
+#########################################
+# PACK RUN                              #
+#########################################
+def pack_run(models_path:str, run:str) ->int:
+    """
+    The function `pack_run` packs the webp directory of a run into its archive. The WebP images are
+    already compressed, so they are stored as they are, while the JSON files are deflated. The archive
+    is written next to its final path and renamed into place, so that it is always complete.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param run The `run` parameter is a string that represents the run directory.
+
+    @return The size of the archive in bytes.
+    """
+
+    webp_dir = path.join(models_path, run, "webp")
+    destination = archive_path(models_path, run)
+    tmp_file = destination + ".tmp"
+
+    if not path.isdir(path.dirname(destination)):
+        makedirs(path.dirname(destination))
+
+    with zipfile.ZipFile(tmp_file, "w") as archive:
+        for root, dirs, files in walk(webp_dir):
+            #Staging leftovers and the blob index are not part of the published run
+            dirs[:] = sorted( d for d in dirs if not d.startswith(".") )
+
+            for name in sorted(files):
+                if name.startswith("."):
+                    continue
+
+                file = path.join(root, name)
+                arcname = path.relpath(file, webp_dir).replace(path.sep, "/")
+                compression = zipfile.ZIP_STORED if name.endswith(".webp") else zipfile.ZIP_DEFLATED
+                archive.write(file, arcname, compress_type=compression)
+
+    replace(tmp_file, destination)
+
+    return stat(destination).st_size
+
+
+#########################################
+# OPEN ARCHIVE                          #
+#########################################
+def open_archive(models_path:str, run:str):
+    """
+    The function `open_archive` returns the open archive of a run, opening it only the first time and
+    again whenever the file is replaced. The archive can be read by several threads at once.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param run The `run` parameter is a string that represents the run directory.
+
+    @return The `zipfile.ZipFile`, or None if the run is not archived.
+    """
+
+    archive_file = archive_path(models_path, run)
+    try:
+        st = stat(archive_file)
+    except FileNotFoundError:
+        return None
+
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    with _archives_lock:
+        if run in _archives and _archives[run][0] == key:
+            _archives.move_to_end(run)
+            return _archives[run][1]
+
+    try:
+        archive = zipfile.ZipFile(archive_file)
+    except Exception as e:
+        msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)} | {run}"
+        logging.error(msg)
+        return None
+
+    with _archives_lock:
+        #The evicted archives are closed by the garbage collector once no request is reading them
+        _archives[run] = (key, archive)
+        _archives.move_to_end(run)
+        while len(_archives) > ARCHIVE_HANDLES:
+            _archives.popitem(last=False)
+
+    return archive
+
+
+#########################################
+# READ ARCHIVED FILE                    #
+#########################################
+def read_archived_file(models_path:str, run:str, filename:str):
+    """
+    The function `read_archived_file` reads a single file of an archived run, with a random-access read
+    of its entry.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param run The `run` parameter is a string that represents the run directory.
+    @param filename The `filename` parameter is the path of the file inside the webp directory of the
+    run, with "/" separators.
+
+    @return The content of the file, or None if the run is not archived or the file does not exist.
+    """
+
+    archive = open_archive(models_path, run)
+    if archive is None:
+        return None
+
+    try:
+        return archive.read(filename)
+    except KeyError:
+        return None
+
+
+#########################################
+# REMOVE ARCHIVE                        #
+#########################################
+def remove_archive(models_path:str, run:str):
+    """
+    The function `remove_archive` deletes the archive of a run.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param run The `run` parameter is a string that represents the run directory.
+    """
+
+    with _archives_lock:
+        _archives.pop(run, None)
+
+    archive_file = archive_path(models_path, run)
+    if path.exists(archive_file):
+        remove(archive_file)
@@ -0,0 +1,200 @@
+import atexit
+import logging
+import queue
+import threading
+from datetime import date, datetime, timezone
+from flask import Flask
+from sqlalchemy import insert, text
+from sqlalchemy.exc import OperationalError
+from app.database import db
+
+
+class AuditLog(object):
+    """
+    It's the per-process pipeline of the user actions: the requests only put the actions in an
+    in-memory queue, and a background thread writes them to the user_actions table in batches,
+    with one INSERT and one commit per batch.
+
+    Every action keeps the time at which it happened. The queue is bounded, so that an outage
+    of the database cannot exhaust the memory of the worker: while the database is unreachable
+    the actions are kept and written again, the actions refused by the database are logged.
+    What is still queued is written when the process exits.
+    """
+
+    def __init__(self):
+        self.__app = None
+        self.__queue = None
+        self.__wakeup = threading.Event()
+        self.__flush_lock = threading.Lock()
+        self.__thread_lock = threading.Lock()
+        self.__thread = None
+        self.batch_size = 100
+        self.flush_seconds = 1
+
+
+    def init_app(self, app:Flask):
+        """
+        The function `init_app` configures the queue and the batches, and writes the queued actions
+        when the process exits.
+
+        @param app The `app` parameter is the Flask application object.
+        """
+
+        self.__app = app
+        self.__queue = queue.Queue(app.config["AUDIT_QUEUE_SIZE"])
+        self.batch_size = app.config["AUDIT_BATCH_SIZE"]
+        self.flush_seconds = app.config["AUDIT_FLUSH_SECONDS"]
+
+        atexit.register(self.flush)
+
+
+    def record(self, user_id:int, action_id:int, remote_addr:str=None, http_user_agent:str=None) ->bool:
+        """
+        The function `record` queues an action of a user, starting the background thread on first use.
+
+        @param user_id The `user_id` parameter is the id of the user.
+        @param action_id The `action_id` parameter is the id of the action, e.g. 1 for the login.
+        @param remote_addr The `remote_addr` parameter is the IP of the user.
+        @param http_user_agent The `http_user_agent` parameter is the browser of the user.
+
+        @return False if the queue is full and the action has been dropped, True otherwise.
+        """
+
+        row = {
+            "user_id": user_id,
+            "action_id": action_id,
+            "remote_addr": remote_addr[:255] if remote_addr else remote_addr,
+            "http_user_agent": http_user_agent[:255] if http_user_agent else http_user_agent,
+            "datetime": datetime.now(timezone.utc)
+        }
+
+        try:
+            self.__queue.put_nowait(row)
+        except queue.Full:
+            logging.error(f"Audit queue full: action {action_id} of user {user_id} not recorded")
+            return False
+
+        with self.__thread_lock:
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name="audit-log", daemon=True)
+                self.__thread.start()
+
+        if self.__queue.qsize() >= self.batch_size:
+            self.__wakeup.set()
+
+        return True
+
+
+    def flush(self):
+        """
+        The function `flush` writes all the queued actions, in batches of AUDIT_BATCH_SIZE rows.
+        """
+
+        if self.__queue is None:
+            return
+
+        with self.__flush_lock:
+            while True:
+                rows = []
+                while len(rows) < self.batch_size:
+                    try:
+                        rows.append( self.__queue.get_nowait() )
+                    except queue.Empty:
+                        break
+
+                if not rows:
+                    return
+
+                try:
+                    self.__write(rows)
+                except OperationalError as e:
+                    #The database is unreachable: the batch is queued again and written at the next interval
+                    msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)} | {len(rows)} actions delayed"
+                    logging.error(msg)
+                    self.__requeue(rows)
+                    return
+                except Exception:
+                    #A row refused by the database must not drop the whole batch
+                    for row in rows:
+                        try:
+                            self.__write([row])
+                        except Exception as e:
+                            msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)} | Action not recorded: {row}"
+                            logging.error(msg)
+
+
+    def __write(self, rows:list):
+        from app.models import User_actions
+
+        with self.__app.app_context():
+            db.session.execute(insert(User_actions), rows)
+            db.session.commit()
+
+
+    def __requeue(self, rows:list):
+        for position, row in enumerate(rows):
+            try:
+                self.__queue.put_nowait(row)
+            except queue.Full:
+                logging.error(f"Audit queue full: {len(rows) - position} actions not recorded: {rows[position:]}")
+                return
+
+
+    def __run(self):
+        while True:
+            self.__wakeup.wait(self.flush_seconds)
+            self.__wakeup.clear()
+
+            try:
+                self.flush()
+            except Exception as e:
+                msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+                logging.error(msg)
+
+
+#########################################
+# CREATE AUDIT PARTITIONS               #
+#########################################
+def create_audit_partitions(schema:str, months_ahead:int) ->list:
+    """
+    The function `create_audit_partitions` creates the monthly partitions of the user_actions table,
+    from the current month to `months_ahead` months ahead. The months are in UTC, like the bounds of the
+    partitions created by the migration. The table is partitioned by range of datetime only on
+    PostgreSQL, elsewhere nothing is done.
+
+    @param schema The `schema` parameter is the database schema of the application.
+    @param months_ahead The `months_ahead` parameter is the number of months created in advance.
+
+    @return The list of the partitions created.
+    """
+
+    if db.engine.dialect.name != "postgresql":
+        return []
+
+    partitioned = db.session.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = :schema AND c.relname = 'user_actions'"
+    ), {"schema": schema}).first()
+    if partitioned is None:
+        return []
+
+    created = []
+
+    today = datetime.now(timezone.utc).date()
+    for offset in range(months_ahead + 1):
+        year, month = divmod(today.month - 1 + offset, 12)
+        start = date(today.year + year, month + 1, 1)
+        end = date(start.year + start.month // 12, start.month % 12 + 1, 1)
+        name = f"user_actions_y{start.year}m{start.month:02d}"
+
+        exists = db.session.execute(text("SELECT to_regclass(:name)"), {"name": f"{schema}.{name}"}).scalar()
+        if exists is None:
+            db.session.execute(text(f"CREATE TABLE {schema}.{name} PARTITION OF {schema}.user_actions FOR VALUES FROM ('{start} 00:00+00') TO ('{end} 00:00+00')"))
+            created.append(name)
+
+    db.session.commit()
+
+    return created
+
+
+audit_log = AuditLog()
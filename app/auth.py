@@ -1,22 +1,41 @@
 import datetime
-import bcrypt
-from flask import (Blueprint, abort, current_app, flash, redirect, request,
+import logging
+from flask import (Blueprint, abort, current_app, flash, jsonify, redirect, request,
                    session, url_for)
+from flask_wtf.csrf import generate_csrf
 from flask_login import login_required, login_user, logout_user
 from jinja2 import TemplateNotFound
+from app.audit import audit_log
 from app.database import db
 from app.form import login_form
-from app.models import User_actions, Users
+from app.login_protection import login_rate_limiter, password_verifier
+from app.models import Users
 
 
 auth = Blueprint('auth', __name__)
 
 
+@auth.route('/api/csrf-token/')
+def csrf_token():
+    """
+    The function `csrf_token` returns the CSRF token of the login form. It is requested by the login
+    modal only when it is opened, so the session of a visitor is created only when they log in.
+
+    @return A JSON response with the token, never cached.
+    """
+
+    response = jsonify({"success": True, "value": generate_csrf()})
+    response.cache_control.no_store = True
+
+    return response
+
+
 @auth.route('/autenticazione', methods = ['POST'])
 def login_post():
     """
     This function handles the login process by validating the user's credentials, logging them in, and
-    recording the login action in the database.
+    recording the login action in the database. The attempts are rate limited by IP and by account, and
+    the password is checked by the bounded bcrypt pool, never on the request thread.
     
     @return The code is returning a redirect to the 'main.index' route.
     """
@@ -29,18 +48,39 @@ def login_post():
             mail = form.mail.data.lower().strip()
             password = form.password.data.strip()
         
+            retry_after = login_rate_limiter.check(request.remote_addr, mail)
+            if retry_after:
+                flash(f'Troppi tentativi di accesso, riprova fra {retry_after // 60 + 1} minuti.', 'danger')
+                return redirect(url_for('main.index'))
+
             user = Users.query.filter_by(mail=mail).first()
+            verified = password_verifier.verify(password, user.password) if user else False
 
-            if not user or not bcrypt.checkpw(password.encode('utf8'), user.password):
+            if verified is None:
+                flash('Troppe richieste di accesso in corso, riprova fra qualche istante.', 'warning')
+            elif not verified:
+                login_rate_limiter.failure(mail)
                 flash('Credenziali errate.', 'danger')
             else:
+                login_rate_limiter.success(mail)
+
+                #The hashes computed with a different cost factor are replaced while the password is known
+                if password_verifier.needs_rehash(user.password):
+                    rehashed = password_verifier.hash(password)
+                    if rehashed:
+                        try:
+                            user.password = rehashed
+                            db.session.commit()
+                        except Exception as e:
+                            db.session.rollback()
+                            msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+                            logging.error(msg)
+
                 login_user(user)
                 session['user'] = user.id
                 session["last_active"] = datetime.datetime.now()
             
-                user_action = User_actions(user_id=user.id, remote_addr=request.remote_addr, http_user_agent=request.headers.get('User-Agent'), action_id=1)
-                db.session.add(user_action)
-                db.session.commit()
+                audit_log.record(user.id, 1, request.remote_addr, request.headers.get('User-Agent'))
 
                 flash('Autenticazione riuscita.', 'success')
 
@@ -61,9 +101,7 @@ def logout():
 
     try:
         user = session['user']
-        user_action = User_actions(user_id=user, remote_addr=request.remote_addr, http_user_agent=request.headers.get('User-Agent'), action_id=2)
-        db.session.add(user_action)
-        db.session.commit()
+        audit_log.record(user, 2, request.remote_addr, request.headers.get('User-Agent'))
 
         logout_user()
         return redirect(url_for('main.index'))
@@ -0,0 +1,226 @@
+import hashlib
+import json
+import logging
+import re
+import shutil
+import threading
+import time
+from os import link, listdir, makedirs, path, remove, replace, rmdir, stat
+from app.retention import move_to_trash
+
+
+#Content-addressed store shared by all the runs, the WebP outputs of a source image live in
+#.blobs/<key[:2]>/<key>/ and are hardlinked into the webp directories of the runs that deliver it
+BLOBS_DIRNAME = ".blobs"
+BLOB_KEY_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+#Names of the outputs inside a blob directory
+BLOB_FRAME = "frame.webp"
+BLOB_THUMB = "thumb.webp"
+
+#The frame → key map of a run lives in its webp directory, it is hidden so that it is not taken for a model
+BLOB_INDEX_FILENAME = ".blobs.json"
+
+
+#########################################
+# BLOB KEY                              #
+#########################################
+def blob_key(png:str, settings:dict) ->str:
+    """
+    The function `blob_key` computes the content address of the WebP outputs of a PNG image: the
+    SHA-256 of the PNG bytes and of the encoder settings, so that the same image encoded differently
+    gets a different blob.
+
+    @param png The `png` parameter is a string that represents the path of the source image.
+    @param settings The `settings` parameter is a JSON serializable dictionary with everything that
+    changes the outputs, e.g. the thumbnail size, the rendition widths and the encoder profile.
+
+    @return The hexadecimal digest.
+    """
+
+    digest = hashlib.sha256()
+
+    with open(png, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+
+    digest.update( json.dumps(settings, sort_keys=True).encode() )
+
+    return digest.hexdigest()
+
+
+#########################################
+# BLOB PATH                             #
+#########################################
+def blob_path(blobs_dir:str, key:str) ->str:
+    """
+    The function `blob_path` returns the directory of a blob.
+
+    @param blobs_dir The `blobs_dir` parameter is the path of the blob store.
+    @param key The `key` parameter is the content address of the blob.
+
+    @return The path of the blob directory.
+    """
+
+    return path.join(blobs_dir, key[:2], key)
+
+
+#########################################
+# STORE BLOB                            #
+#########################################
+def store_blob(staged_blob:str, blob:str):
+    """
+    The function `store_blob` moves a blob built in a staging directory into the store with a single
+    rename, so that a blob directory is always complete. If another worker has stored the same blob in
+    the meantime, the staged copy is dropped.
+
+    @param staged_blob The `staged_blob` parameter is the path of the complete blob directory to store.
+    It must be on the same filesystem of the store.
+    @param blob The `blob` parameter is the path of the blob directory in the store.
+    """
+
+    makedirs(path.dirname(blob), exist_ok=True)
+
+    try:
+        replace(staged_blob, blob)
+    except OSError:
+        if not path.isdir(blob):
+            raise
+        shutil.rmtree(staged_blob, ignore_errors=True)
+
+
+#########################################
+# LINK BLOB                             #
+#########################################
+def link_blob(source:str, destination:str, staging_dir:str) ->bool:
+    """
+    The function `link_blob` publishes a file of a blob into the webp directory of a run. The hardlink
+    is created in the staging directory and renamed into place, so that a reader never finds a missing
+    or partial image. Where hardlinks are not supported the file is copied.
+
+    @param source The `source` parameter is the path of the file inside the blob directory.
+    @param destination The `destination` parameter is the path of the image in the run.
+    @param staging_dir The `staging_dir` parameter is the staging directory of the run.
+
+    @return True if the file has been linked, False if it has been copied: a copy does not hold a
+    reference to the blob, which can then be purged.
+    """
+
+    staged_file = path.join(staging_dir, path.basename(destination))
+    if path.exists(staged_file):
+        remove(staged_file)
+
+    linked = True
+    try:
+        link(source, staged_file)
+    except OSError:
+        shutil.copy2(source, staged_file)
+        linked = False
+
+    replace(staged_file, destination)
+
+    return linked
+
+
+#########################################
+# READ BLOB INDEX                       #
+#########################################
+def read_blob_index(webp_dir:str) ->dict:
+    """
+    The function `read_blob_index` reads the map from the frames of a run to their blobs.
+
+    @param webp_dir The `webp_dir` parameter is the webp directory of the run.
+
+    @return A dictionary mapping every frame file name to its blob key, empty if the run has no index.
+    """
+
+    try:
+        with open(path.join(webp_dir, BLOB_INDEX_FILENAME)) as j:
+            return json.load(j)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+        logging.error(msg)
+        return {}
+
+
+#########################################
+# WRITE BLOB INDEX                      #
+#########################################
+def write_blob_index(webp_dir:str, blobs:dict, staging_dir:str):
+    """
+    The function `write_blob_index` merges the keys of the frames just converted into the blob index of
+    a run. The file is written in the staging directory and renamed into place.
+
+    @param webp_dir The `webp_dir` parameter is the webp directory of the run.
+    @param blobs The `blobs` parameter is a dictionary mapping the frame file names to their blob keys.
+    The frames mapped to None are removed from the index, so that they are served from the run.
+    @param staging_dir The `staging_dir` parameter is the staging directory of the run.
+    """
+
+    index = read_blob_index(webp_dir)
+    index.update(blobs)
+    index = {frame: key for frame, key in index.items() if key is not None}
+
+    staged_file = path.join(staging_dir, BLOB_INDEX_FILENAME)
+    with open(staged_file, "w") as outfile:
+        json.dump(index, outfile, indent = 4, sort_keys=True)
+    replace(staged_file, path.join(webp_dir, BLOB_INDEX_FILENAME))
+
+
+#########################################
+# PURGE BLOBS                           #
+#########################################
+def purge_blobs(models_path:str, lock:threading.Lock, max_seconds:float, cursor:str="") ->tuple:
+    """
+    The function `purge_blobs` moves to the trash the blobs that are no longer used by any run. Every
+    run holds a hardlink to the files it uses, so the link count of the files is the reference count of
+    the blob: a blob whose files are linked only by the store can be removed.
+
+    The store is scanned in order of key for at most `max_seconds` seconds, and the scan is resumed by
+    the next call from the returned cursor. A blob is stored before being linked by its run, so every
+    blob is checked and moved holding `lock`, which the ingestion holds while it links the blobs: the
+    lock is taken blob by blob, so the ingestion is never kept waiting for the whole scan.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param lock The `lock` parameter is the lock held by the ingestion.
+    @param max_seconds The `max_seconds` parameter is the time budget of the scan.
+    @param cursor The `cursor` parameter is the position to resume the scan from, "" to start it.
+
+    @return A tuple with the number of blobs removed and the cursor of the next call, or None if the
+    scan is complete.
+    """
+
+    purged = 0
+
+    blobs_dir = path.join(models_path, BLOBS_DIRNAME)
+    if not path.isdir(blobs_dir):
+        return purged, None
+
+    deadline = time.monotonic() + max_seconds
+    last_shard, _, last_key = cursor.partition("/")
+
+    for shard in sorted( s for s in listdir(blobs_dir) if s >= last_shard ):
+        shard_dir = path.join(blobs_dir, shard)
+
+        for key in sorted( k for k in listdir(shard_dir) if shard > last_shard or k > last_key ):
+            blob = path.join(shard_dir, key)
+            try:
+                with lock:
+                    if all( stat(path.join(blob, f)).st_nlink <= 1 for f in listdir(blob) ):
+                        move_to_trash(models_path, blob, "blob_" + key)
+                        purged += 1
+            except Exception as e:
+                msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)} | {key}"
+                logging.error(msg)
+
+            if time.monotonic() >= deadline:
+                return purged, f"{shard}/{key}"
+
+        with lock:
+            if not listdir(shard_dir):
+                rmdir(shard_dir)
+
+    return purged, None
@@ -0,0 +1,637 @@
+import calendar
+import hashlib
+import json
+import logging
+import threading
+from os import listdir, makedirs, path, remove, replace, stat
+from pathlib import Path
+from PIL import Image
+from app.archive import list_archived_runs, open_archive
+from app.blobs import read_blob_index
+from app.images import ANIMATIONS_DIRNAME, RENDITIONS_DIRNAME, parse_rendition_name, rendition_name
+
+
+STAMP_FILENAME = ".catalog.json"
+STAMP_EVENTS = 100
+SNAPSHOTS_DIRNAME = ".snapshots"
+
+
+class Catalog(object):
+    """
+    It's a process-wide, in-memory index of the runs published under MODELS_PATH
+    (run -> model JSON -> variables -> image frames -> thumbnail).
+
+    Every run is indexed once, the first time it is requested, and kept in memory
+    until `process_models` publishes new content for it. Publications are announced
+    through a small stamp file in MODELS_PATH, so every process checks for changes
+    with a single stat() per request. Other caches of the read path can subscribe
+    to the publications to be invalidated together with the catalog.
+    """
+
+    def __init__(self):
+        self.__lock = threading.RLock()
+        self.__models_path = None
+        self.__stamp = None
+        self.__version = 0
+        self.__versions = {}
+        self.__events = []
+        self.__runs = {}
+        self.__days = None
+        self.__snapshots = {}
+        self.__subscribers = []
+
+
+    @property
+    def version(self) ->int:
+        """
+        It returns the version of the catalog, increased on every publication.
+
+        @return An integer.
+        """
+
+        return self.__version
+
+
+    def subscribe(self, callback):
+        """
+        The function `subscribe` registers a callback that is called, with the set of the runs that
+        have been published again, every time this process notices a new publication.
+
+        @param callback The `callback` parameter is a function accepting a set of run directories.
+        """
+
+        with self.__lock:
+            self.__subscribers.append(callback)
+
+
+    def refresh(self, models_path:str):
+        """
+        The function `refresh` checks the stamp file and drops from memory the runs that have been
+        published again since the last check.
+
+        @param models_path The `models_path` parameter is a string that represents the path to the
+        directory where the runs are stored.
+        """
+
+        with self.__lock:
+            if models_path != self.__models_path:
+                self.__models_path = models_path
+                self.__stamp = None
+                self.__version = 0
+                self.__versions = {}
+                self.__events = []
+                self.__runs = {}
+                self.__days = None
+                self.__snapshots = {}
+
+            stamp_file = path.join(models_path, STAMP_FILENAME)
+            try:
+                st = stat(stamp_file)
+                stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+            except FileNotFoundError:
+                stamp = None
+
+            if stamp == self.__stamp:
+                return
+
+            content = read_stamp(models_path)
+            versions = content["runs"]
+
+            changed = set()
+            for run in set(self.__versions) | set(versions):
+                if self.__versions.get(run) != versions.get(run):
+                    self.__runs.pop(run, None)
+                    self.__snapshots.pop(run[0:8], None)
+                    changed.add(run)
+
+            self.__stamp = stamp
+            self.__version = content["version"]
+            self.__versions = versions
+            self.__events = content["events"]
+            self.__days = None
+
+            for callback in self.__subscribers:
+                try:
+                    callback(changed)
+                except Exception as e:
+                    msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+                    logging.error(msg)
+
+
+    def get_events(self, since:int) ->list:
+        """
+        The function `get_events` returns the publications noticed by this process after a given
+        version, as recorded in the stamp file.
+
+        @param since The `since` parameter is the catalog version of the last publication already known.
+
+        @return A list of dictionaries with the "id" (the catalog version), the published "runs", the
+        "removed" runs.
+        """
+
+        with self.__lock:
+            return [e for e in self.__events if e["id"] > since]
+
+
+    def get_days(self, models_path:str) ->dict:
+        """
+        The function `get_days` returns the index of the available days, each one with the sorted
+        list of its runs.
+
+        @param models_path The `models_path` parameter is a string that represents the path to the
+        directory where the runs are stored.
+
+        @return A dictionary mapping a day in the format "YYYYMMDD" to the list of its runs.
+        """
+
+        with self.__lock:
+            self.refresh(models_path)
+            return self.__get_days()
+
+
+    def get_run(self, models_path:str, run:str) ->dict:
+        """
+        The function `get_run` returns the index of a single run, building it on first access.
+
+        @param models_path The `models_path` parameter is a string that represents the path to the
+        directory where the runs are stored.
+        @param run The `run` parameter is a string that represents the run directory, in the format
+        "YYYYMMDDHH".
+
+        @return A dictionary with the indexed models of the run, or None if the run does not exist.
+        """
+
+        with self.__lock:
+            self.refresh(models_path)
+
+            #The run comes from the URL: only the available runs are indexed and kept in memory
+            if run not in self.__get_days().get(run[0:8], []):
+                return None
+
+            return self.__get_run(run)
+
+
+    def get_snapshot(self, models_path:str, day:str) ->dict:
+        """
+        The function `get_snapshot` returns the dashboard snapshot of a day, reading it from disk only
+        the first time after every publication of one of its runs. If the snapshot has not been written
+        yet, it is built from the catalog index.
+
+        @param models_path The `models_path` parameter is a string that represents the path to the
+        directory where the runs are stored.
+        @param day The `day` parameter is a string representing the date in the format "YYYYMMDD".
+
+        @return A dictionary mapping every run of the day to its "public" and "authenticated" cards.
+        """
+
+        with self.__lock:
+            self.refresh(models_path)
+
+            #The day comes from the URL: only the days with available runs are kept in memory
+            day_runs = self.__get_days().get(day)
+            if not day_runs:
+                return {}
+
+            if day not in self.__snapshots:
+                snapshot = read_snapshot(models_path, day)
+                if snapshot is None:
+                    runs = [self.__get_run(run) for run in day_runs]
+                    snapshot = {r["run"]: run_cards(r) for r in runs if r is not None}
+                if not snapshot:
+                    return snapshot
+                self.__snapshots[day] = snapshot
+
+            return self.__snapshots[day]
+
+
+    def __get_days(self) ->dict:
+        if self.__days is None:
+            days = {}
+            archived = set(list_archived_runs(self.__models_path))
+            for run in list_available_runs(self.__models_path):
+                if run in archived or path.isdir(path.join(self.__models_path, run, "webp")):
+                    days.setdefault(run[0:8], []).append(run)
+            self.__days = days
+
+        return self.__days
+
+
+    def __get_run(self, run:str) ->dict:
+        if run not in self.__runs:
+            indexed_run = index_run(self.__models_path, run)
+            if indexed_run is None:
+                return None
+            self.__runs[run] = indexed_run
+
+        return self.__runs[run]
+
+
+catalog = Catalog()
+
+
+#########################################
+# LIST RUNS                             #
+#########################################
+def list_runs(models_path:str) ->list:
+    """
+    The function `list_runs` lists the run directories stored under MODELS_PATH, skipping the hidden
+    directories used for the application bookkeeping.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+
+    @return The sorted list of the run directory names.
+    """
+
+    return sorted( item for item in listdir(models_path) if not item.startswith(".") and path.isdir(path.join(models_path, item)) )
+
+
+#########################################
+# LIST AVAILABLE RUNS                   #
+#########################################
+def list_available_runs(models_path:str) ->list:
+    """
+    The function `list_available_runs` lists the runs that can be browsed: the run directories and
+    the runs packed into the archive.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+
+    @return The sorted list of the run names.
+    """
+
+    return sorted( set(list_runs(models_path)) | set(list_archived_runs(models_path)) )
+
+
+#########################################
+# READ STAMP                            #
+#########################################
+def read_stamp(models_path:str) ->dict:
+    """
+    The function `read_stamp` reads the stamp file that records the publications of the runs.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+
+    @return A dictionary with the global "version", the version of every published run and the list
+    of the last publication "events".
+    """
+
+    try:
+        with open(path.join(models_path, STAMP_FILENAME)) as j:
+            content = json.load(j)
+        return {"version": int(content["version"]), "runs": dict(content["runs"]), "events": list(content.get("events", []))}
+    except FileNotFoundError:
+        return {"version": 0, "runs": {}, "events": []}
+    except Exception as e:
+        msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+        logging.error(msg)
+        return {"version": 0, "runs": {}, "events": []}
+
+
+#########################################
+# PUBLISH                               #
+#########################################
+def publish(models_path:str, runs:list):
+    """
+    The function `publish` announces that new content is available for the given runs, so that
+    every process drops them from its catalog. The stamp file is replaced atomically and keeps the
+    last publications as events for the clients that are listening for them.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param runs The `runs` parameter is a list of run directories that have been changed.
+    """
+
+    if not runs:
+        return
+
+    available = set(list_available_runs(models_path))
+
+    content = read_stamp(models_path)
+    content["version"] += 1
+    content["runs"] = {r: v for r, v in content["runs"].items() if r in available}
+    for run in runs:
+        content["runs"][run] = content["version"]
+
+    content["events"].append({
+        "id": content["version"],
+        "runs": sorted(runs),
+        "removed": sorted( r for r in runs if r not in available ),
+    })
+    content["events"] = content["events"][-STAMP_EVENTS:]
+
+    tmp_file = path.join(models_path, STAMP_FILENAME + ".tmp")
+    with open(tmp_file, "w") as outfile:
+        json.dump(content, outfile)
+    replace(tmp_file, path.join(models_path, STAMP_FILENAME))
+
+
+#########################################
+# RUN CARDS                             #
+#########################################
+def run_cards(indexed_run:dict) ->dict:
+    """
+    The function `run_cards` extracts the dashboard cards of a run from its index.
+
+    @param indexed_run The `indexed_run` parameter is the dictionary returned by `index_run`.
+
+    @return A dictionary with the "public" cards, shown to everybody, and the "authenticated" ones.
+    """
+
+    models = [indexed_run["models"][n] for n in indexed_run["names"]]
+
+    return {
+        "public": [m["card"] for m in models if m["pubblico"]],
+        "authenticated": [m["card"] for m in models],
+    }
+
+
+#########################################
+# READ SNAPSHOT                         #
+#########################################
+def read_snapshot(models_path:str, day:str):
+    """
+    The function `read_snapshot` reads the dashboard snapshot of a day.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param day The `day` parameter is a string representing the date in the format "YYYYMMDD".
+
+    @return A dictionary mapping every run of the day to its cards, or None if there is no snapshot.
+    """
+
+    try:
+        with open(path.join(models_path, SNAPSHOTS_DIRNAME, day + ".json")) as j:
+            return json.load(j)["runs"]
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+        logging.error(msg)
+        return None
+
+
+#########################################
+# UPDATE SNAPSHOTS                      #
+#########################################
+def update_snapshots(models_path:str, runs:list):
+    """
+    The function `update_snapshots` rebuilds the dashboard snapshots of the days of the given runs. Only
+    the changed runs, and the ones still missing from the snapshot, are indexed again; the runs that
+    have been removed are dropped. It has to be called before `publish`, so that the web processes find
+    the new snapshot as soon as they notice the publication.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param runs The `runs` parameter is a list of run directories that have been changed or removed.
+    """
+
+    snapshots_dir = path.join(models_path, SNAPSHOTS_DIRNAME)
+    available = list_available_runs(models_path)
+
+    for day in sorted( set(run[0:8] for run in runs) ):
+        snapshot = read_snapshot(models_path, day) or {}
+
+        day_runs = [r for r in available if r[0:8] == day]
+        for run in day_runs:
+            if run in runs or run not in snapshot:
+                indexed_run = index_run(models_path, run)
+                if indexed_run is not None:
+                    snapshot[run] = run_cards(indexed_run)
+
+        snapshot = {r: snapshot[r] for r in sorted(snapshot) if r in day_runs}
+
+        snapshot_file = path.join(snapshots_dir, day + ".json")
+        if not snapshot:
+            if path.exists(snapshot_file):
+                remove(snapshot_file)
+            continue
+
+        if not path.exists(snapshots_dir):
+            makedirs(snapshots_dir)
+
+        tmp_file = snapshot_file + ".tmp"
+        with open(tmp_file, "w") as outfile:
+            json.dump({"day": day, "runs": snapshot}, outfile, separators=(",", ":"))
+        replace(tmp_file, snapshot_file)
+
+
+#########################################
+# OPEN RUN                              #
+#########################################
+def open_run(models_path:str, run:str):
+    """
+    The function `open_run` gives access to the published files of a run, either in its webp directory
+    or in its archive.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param run The `run` parameter is a string that represents the run directory.
+
+    @return A tuple with the list of the paths of the files relative to the webp directory, with "/"
+    separators, a function opening one of them in binary mode and a flag telling if the run is
+    archived, or None if the run does not exist.
+    """
+
+    webp_dir = path.join(models_path, run, "webp")
+    if path.isdir(webp_dir):
+        listing = listdir(webp_dir)
+        for subdir in ("thumbs", ANIMATIONS_DIRNAME, RENDITIONS_DIRNAME):
+            if path.isdir(path.join(webp_dir, subdir)):
+                listing += [f"{subdir}/{f}" for f in listdir(path.join(webp_dir, subdir))]
+
+        return (listing, lambda f: open(path.join(webp_dir, *f.split("/")), "rb"), False)
+
+    archive = open_archive(models_path, run)
+    if archive is not None:
+        return (archive.namelist(), archive.open, True)
+
+    return None
+
+
+#########################################
+# INDEX RUN                             #
+#########################################
+def index_run(models_path:str, run:str):
+    """
+    The function `index_run` lists the webp directory of a run once and reads all its model JSON
+    files, precomputing everything the views need. An archived run is indexed in the same way from the
+    entries of its archive.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param run The `run` parameter is a string that represents the run directory.
+
+    @return A dictionary with the run name, the sorted model names, the indexed models, the
+    visibility map of the frames, the images available for every frame with renditions, as sorted
+    (width, file) pairs from the smallest rendition to the full-size frame, the blob key of
+    every frame and the version of every animation, or None if the run has neither a webp
+    directory nor an archive.
+    """
+
+    source = open_run(models_path, run)
+    if source is None:
+        return None
+
+    listing, open_file, archived = source
+
+    files = sorted( f for f in listing if "/" not in f )
+    frames = [f for f in files if f.endswith(".webp")]
+
+    thumbs = sorted( f[len("thumbs/"):] for f in listing if f.startswith("thumbs/") )
+
+    models = {}
+    for json_file in [f for f in files if f.endswith(".json") and not f.startswith(".")]:
+        name = json_file[:-len(".json")]
+        try:
+            with open_file(json_file) as j:
+                jdata = json.load(j)
+
+            model = index_model(name, jdata, frames, thumbs)
+            if model is not None:
+                models[name] = model
+        except Exception as e:
+            msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)} | {run}/{json_file}"
+            logging.error(msg)
+
+    animations = set( f[len(ANIMATIONS_DIRNAME + "/"):] for f in listing if f.startswith(ANIMATIONS_DIRNAME + "/") )
+
+    #A frame is public if at least one public model shows it, its thumbnail follows the frame.
+    #An animation is rebuilt in place when frames are added, so it is versioned by its index
+    visibility = {}
+    versions = {}
+    for model in models.values():
+        for images in model["images"].values():
+            for frame in images["files"]:
+                visibility[frame] = visibility.get(frame, False) or model["pubblico"]
+
+            #The index is published after the animation, so the animation is complete if the index exists
+            if images["prefix"] + ".json" in animations:
+                try:
+                    with open_file(f"{ANIMATIONS_DIRNAME}/{images['prefix']}.json") as j:
+                        index = json.load(j)
+
+                    animation = f"{ANIMATIONS_DIRNAME}/{images['prefix']}.webp"
+                    versions[animation] = hashlib.sha256( json.dumps(index, sort_keys=True).encode("utf-8") ).hexdigest()[:16]
+                    images["animation"] = {"file": animation, "timestamps": index["timestamps"], "duration": index["duration"], "version": versions[animation]}
+                    visibility[animation] = visibility.get(animation, False) or model["pubblico"]
+                except Exception as e:
+                    msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)} | {run}/{images['prefix']}"
+                    logging.error(msg)
+
+    renditions = {}
+    for name in [f[len(RENDITIONS_DIRNAME + "/"):] for f in listing if f.startswith(RENDITIONS_DIRNAME + "/")]:
+        rendition = parse_rendition_name(name)
+        if rendition is not None:
+            renditions.setdefault(rendition[0], []).append(rendition[1])
+
+    #The frames of a variable share the same size, so only the headers of the first one and of its
+    #thumbnail are read. The thumbnail is listed with the renditions, being smaller than most of them
+    thumbs = set(thumbs)
+    widths = {}
+    for model in models.values():
+        for images in model["images"].values():
+            files = [f for f in images["files"] if f in renditions and f not in widths]
+            if not files:
+                continue
+
+            try:
+                with open_file(files[0]) as f, Image.open(f) as image:
+                    width = image.width
+            except Exception as e:
+                msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)} | {run}/{files[0]}"
+                logging.error(msg)
+                continue
+
+            thumb_width = None
+            if "thumb_" + files[0] in thumbs:
+                try:
+                    with open_file("thumbs/thumb_" + files[0]) as f, Image.open(f) as image:
+                        thumb_width = image.width
+                except Exception as e:
+                    msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)} | {run}/thumbs/thumb_{files[0]}"
+                    logging.error(msg)
+
+            for frame in files:
+                frame_widths = {w: RENDITIONS_DIRNAME + "/" + rendition_name(frame, w) for w in renditions[frame]}
+                if thumb_width is not None and "thumb_" + frame in thumbs:
+                    frame_widths.setdefault(thumb_width, "thumbs/thumb_" + frame)
+                frame_widths[width] = frame
+                widths[frame] = sorted(frame_widths.items())
+
+    #The images of an archived run are served from the archive, not from the blob store
+    blobs = read_blob_index(path.join(models_path, run, "webp")) if not archived else {}
+
+    return {"run": run, "names": sorted(models), "models": models, "visibility": visibility, "widths": widths, "blobs": blobs, "versions": versions}
+
+
+#########################################
+# INDEX MODEL                           #
+#########################################
+def index_model(name:str, jdata:dict, frames:list, thumbs:list):
+    """
+    The function `index_model` builds the dashboard card, the variables and the frames of a model
+    from its JSON data and from the listings of its run.
+
+    @param name The `name` parameter is a string that represents the name of the model, i.e. the
+    JSON file name without extension.
+    @param jdata The `jdata` parameter is the dictionary loaded from the model JSON file.
+    @param frames The `frames` parameter is the sorted list of the webp files of the run.
+    @param thumbs The `thumbs` parameter is the sorted list of the thumbnails of the run.
+
+    @return A dictionary with the indexed model, or None if the name is not a map or a section.
+    """
+
+    if name.startswith("map_"):
+        title = jdata["etichetta"].split("_")[1:]
+        key, label = "like", "title"
+    elif name.startswith("section_"):
+        title = jdata["etichetta"].split("_")
+        key, label = "file", "name"
+    else:
+        return None
+
+    percorso = jdata["percorso"]
+    tags = [jdata["nomeModello"], jdata["tipo"]]
+
+    variables = []
+    images = {}
+    for img in jdata["immagini"]:
+        prefix = img["like"] if key == "like" else str(Path(img["file"]).with_suffix(''))
+        thumb = next((t for t in thumbs if t.startswith("thumb_" + prefix) and t.endswith(".webp")), "")
+
+        variables.append({
+            "title": img[label],
+            "thumbs": thumb,
+            "tags": tags,
+            "dataEmissione": jdata["dataEmissione"],
+            "etichetta": jdata["etichetta"],
+            "variable": img[key],
+            "percorso": percorso,
+        })
+
+        images[img[key]] = {
+            "title": img[label],
+            "prefix": prefix,
+            "files": [f for f in frames if f.startswith(prefix)],
+            "animation": None,
+        }
+
+    card = {
+        "title": ' '.join([t.title() for t in title]),
+        "thumbs": variables[0]["thumbs"] if variables else "",
+        "dataEmissione": jdata["dataEmissione"],
+        "etichetta": jdata["etichetta"],
+        "percorso": percorso,
+        "tags": tags,
+    }
+
+    return {
+        "pubblico": jdata["pubblico"],
+        "string_date": f'{percorso[6:8]} {calendar.month_name[ int( percorso[4:6] ) ].title()} {percorso[0:4]}',
+        "string_run": f'Corsa del {percorso[8:10]} UTC',
+        "card": card,
+        "variables": variables,
+        "images": images,
+    }
@@ -1,7 +1,21 @@
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from os import path
+from io import BytesIO
+from pathlib import Path
 import bcrypt
 import click
+from flask import current_app
 from flask.cli import with_appcontext
+from app import scheduler, start_scheduler
 from app.database import db
+from app.descriptors import MAP_MARKER_ATTRIBUTES, SECTION_MARKER_ATTRIBUTES, iter_markers
+from app.images import prepare_image
 from app.models import Users
 
 
@@ -29,7 +43,7 @@ def add_user(mail:str, password:str) ->str:
     """
     
     bytePwd = password.encode('utf-8')
-    mySalt = bcrypt.gensalt()
+    mySalt = bcrypt.gensalt(rounds=current_app.config["BCRYPT_ROUNDS"])
     hash = bcrypt.hashpw(bytePwd, mySalt)
 
     try:
@@ -40,4 +54,189 @@ def add_user(mail:str, password:str) ->str:
     except Exception as e:
         print( f"Impossibile creare l'utente {mail}: {format(e)}" )
     
-    
\ No newline at end of file
+    
+
+#########################################
+# RUN SCHEDULER                         #
+#########################################
+@click.command("run-scheduler")
+@with_appcontext
+def run_scheduler():
+    """
+    The `run_scheduler` function runs the scheduled tasks in a dedicated worker process, so that the
+    web server workers can be started with SCHEDULER_AUTOSTART=false. The leader lock still
+    guarantees that only one scheduler per host is running.
+    """
+
+    if not start_scheduler(current_app._get_current_object()):
+        print( "Impossibile avviare lo scheduler: un altro processo è già in esecuzione" )
+        sys.exit(1)
+
+    print( f"Scheduler avviato nel processo {os.getpid()}" )
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        scheduler.shutdown()
+
+
+#########################################
+# BENCHMARK DESCRIPTORS                 #
+#########################################
+@click.command("benchmark-descriptors")
+@click.option("--markers", "-n", default=10000, show_default=True)
+@click.option("--repeat", "-r", default=3, show_default=True)
+def benchmark_descriptors(markers:int, repeat:int):
+    """
+    The `benchmark_descriptors` function compares the streaming marker extractor used by the ingestion
+    with the previous BeautifulSoup implementation on synthetic map and section descriptors, checking
+    that both produce the same output.
+
+    @param markers The `markers` parameter is the number of markers of every synthetic descriptor.
+    @param repeat The `repeat` parameter is the number of runs of every parser, the best time is reported.
+    """
+
+    from bs4 import BeautifulSoup as bs4
+
+    def read_markers_bs4(xml_file:str, attributes:tuple) ->list:
+        with open(xml_file, "r") as f:
+            Bs_data = bs4(f.read(), features="xml")
+            return [{a: tag.get(a) for a in attributes} for tag in Bs_data.find_all('marker')]
+
+    def measure(function, *args) ->tuple:
+        best = None
+        for _ in range(repeat):
+            tracemalloc.start()
+            start = time.perf_counter()
+            result = function(*args)
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            best = elapsed if best is None else min(best, elapsed)
+        return result, best, peak
+
+    with tempfile.TemporaryDirectory() as tmp:
+        descriptors = {
+            "map": (MAP_MARKER_ATTRIBUTES, '<marker var="v{i}" title="Variabile {i}" like="v{i}_" offset="{i}" label="Etichetta {i}"/>'),
+            "section": (SECTION_MARKER_ATTRIBUTES, '<marker file="sezione_{i}.png" lat="44.{i}" lon="8.{i}" name="Sezione {i}" nick="S{i}"/>'),
+        }
+
+        for kind, (attributes, marker) in descriptors.items():
+            xml_file = path.join(tmp, f"{kind}_benchmark.xml")
+            with open(xml_file, "w") as f:
+                f.write('<?xml version="1.0" encoding="UTF-8"?>\n<markers>\n')
+                for i in range(markers):
+                    f.write("  " + marker.format(i=i) + "\n")
+                f.write('</markers>\n')
+
+            old, old_time, old_peak = measure(read_markers_bs4, xml_file, attributes)
+            new, new_time, new_peak = measure(lambda x, a: list(iter_markers(x, a)), xml_file, attributes)
+
+            print( f"{kind} ({markers} marker, {path.getsize(xml_file) / 1e6:.1f} MB)" )
+            print( f"    bs4:       {old_time:.3f} s, picco memoria {old_peak / 1e6:.1f} MB" )
+            print( f"    streaming: {new_time:.3f} s, picco memoria {new_peak / 1e6:.1f} MB" )
+            print( f"    output identico: {'sì' if old == new else 'NO'}" )
+
+
+#########################################
+# BENCHMARK WEBP                        #
+#########################################
+@click.command("benchmark-webp")
+@click.argument("source")
+@click.option("--limit", "-n", default=20, show_default=True)
+@with_appcontext
+def benchmark_webp(source:str, limit:int):
+    """
+    The `benchmark_webp` function encodes a sample of frames with every encoder profile configured in
+    `scheduled_tasks.ENCODER_PROFILES` and reports the size of the outputs and the encode time, compared
+    with the Pillow defaults, so that the profiles can be chosen from data.
+
+    @param source The `source` parameter is a directory with the PNG frames of a delivery, or the name of
+    a run under MODELS_PATH. If no PNG is found, the full-size WebP frames of the run are decoded and
+    encoded again, which favours the lossy profiles.
+    @param limit The `limit` parameter is the maximum number of frames of the sample.
+    """
+
+    from PIL import Image
+    from app.scheduled_tasks import BASEDIR, ENCODER_PROFILES
+
+    source_dir = source if path.isdir(source) else path.join(BASEDIR, *current_app.config["MODELS_PATH"], source)
+
+    frames = sorted( str(p) for p in Path(source_dir).glob("*.png") )[:limit]
+    if not frames:
+        frames = sorted( str(p) for p in Path(source_dir, "webp").glob("*.webp") )[:limit]
+    if not frames:
+        print( f"Nessuna immagine trovata in {source_dir}" )
+        sys.exit(1)
+
+    images = []
+    for frame in frames:
+        with Image.open(frame) as image:
+            image.load()
+            images.append(image.copy())
+
+    profiles = {"pillow": {}}
+    profiles.update(ENCODER_PROFILES)
+
+    results = {}
+    for name, profile in profiles.items():
+        size = 0
+        start = time.perf_counter()
+        for image in images:
+            prepared, options = prepare_image(image, profile)
+            buffer = BytesIO()
+            prepared.save(buffer, **options)
+            size += buffer.tell()
+        results[name] = (size, time.perf_counter() - start)
+
+    reference_size, reference_time = results["pillow"]
+    print( f"{len(images)} immagini da {source_dir} ({sum(path.getsize(f) for f in frames) / 1024:.1f} kB)" )
+    for name, (size, elapsed) in results.items():
+        saved = 100 * (1 - size / reference_size)
+        print( f"    {name:<10} {size / 1024:10.1f} kB  {saved:+6.1f}% risparmiati  {elapsed:7.2f} s  {1000 * elapsed / len(images):7.1f} ms/immagine  ({elapsed / reference_time:.1f}x)" )
+
+
+#########################################
+# PRUNE LEGACY SESSIONS                 #
+#########################################
+@click.command("prune-legacy-sessions")
+@click.option("--all", "-a", "remove_all", is_flag=True, help="Remove also the sessions not expired yet, logging out their users")
+@with_appcontext
+def prune_legacy_sessions(remove_all:bool):
+    """
+    The `prune_legacy_sessions` function removes the expired sessions left in SESSION_FILE_DIR by the
+    filesystem backend. The valid ones are moved to the SQLite backend by the first request of their user,
+    so the directory empties by itself within PERMANENT_SESSION_LIFETIME and is then removed. With
+    `--all` every legacy session is removed at once.
+
+    @param remove_all The `remove_all` parameter is a boolean flag to remove also the valid sessions.
+    """
+
+    legacy_dir = current_app.config.get("SESSION_FILE_DIR") or path.join(os.getcwd(), "flask_session")
+    if not path.isdir(legacy_dir):
+        print( f"Nessuna sessione da migrare in {legacy_dir}" )
+        return
+
+    now = time.time()
+    removed = 0
+    left = 0
+
+    for name in os.listdir(legacy_dir):
+        session_file = path.join(legacy_dir, name)
+        try:
+            with open(session_file, "rb") as f:
+                expires = struct.unpack("I", f.read(4))[0]
+
+            #The files without expiry are the bookkeeping of cachelib, not sessions
+            if remove_all or expires < now:
+                os.remove(session_file)
+                removed += 1
+            else:
+                left += 1
+        except (OSError, struct.error):
+            left += 1
+
+    if not left:
+        os.rmdir(legacy_dir)
+
+    print( f"Sessioni rimosse: {removed}, sessioni ancora da migrare: {left}" )
@@ -0,0 +1,31 @@
+from xml.etree.ElementTree import iterparse
+
+
+MAP_MARKER_ATTRIBUTES = ("var", "title", "like", "offset", "label")
+SECTION_MARKER_ATTRIBUTES = ("file", "lat", "lon", "name", "nick")
+
+
+#########################################
+# ITER MARKERS                          #
+#########################################
+def iter_markers(xml_file:str, attributes:tuple):
+    """
+    The function `iter_markers` streams the `<marker>` tags of a map or section XML descriptor without
+    building the whole document tree: every element is discarded as soon as it has been read.
+
+    @param xml_file The `xml_file` parameter is a string that represents the path of the XML descriptor.
+    @param attributes The `attributes` parameter is a tuple with the names of the attributes to extract.
+    Missing attributes are returned as None.
+
+    @return A generator of dictionaries, one for every marker, with the keys in the order of `attributes`.
+    """
+
+    context = iterparse(xml_file, events=("start", "end"))
+    _, root = next(context)
+
+    for event, elem in context:
+        if event == "end":
+            if elem.tag == "marker" or elem.tag.endswith("}marker"):
+                yield {a: elem.get(a) for a in attributes}
+
+            root.clear()
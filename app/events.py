@@ -0,0 +1,120 @@
+import json
+import logging
+import threading
+import time
+from os import path
+from flask import Flask
+from app.catalog import catalog
+
+
+class PublicationFeed(object):
+    """
+    It's the per-process source of the server-sent events announcing the publications of new runs.
+
+    A single background thread checks the catalog stamp and wakes up all the connected
+    clients when a publication is noticed, so hundreds of idle connections cost one
+    stat() per interval to the whole process. The number of clients is bounded, so
+    that the streams never take all the threads of the web server worker.
+    """
+
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__generation = 0
+        self.__clients = 0
+        self.__thread = None
+        self.__models_path = None
+        self.__interval = 1
+        self.__heartbeat = 15
+        self.__max_clients = 0
+
+
+    def init_app(self, app:Flask):
+        """
+        The function `init_app` configures the feed and subscribes it to the publications of the catalog.
+
+        @param app The `app` parameter is the Flask application object.
+        """
+
+        self.__models_path = path.join(app.root_path, *app.config["MODELS_PATH"])
+        self.__interval = app.config["EVENTS_POLL_SECONDS"]
+        self.__heartbeat = app.config["EVENTS_HEARTBEAT_SECONDS"]
+        self.__max_clients = app.config["EVENTS_MAX_CLIENTS"]
+
+        catalog.subscribe(self.__notify)
+
+
+    def connect(self) ->bool:
+        """
+        The function `connect` registers a new client, starting the background thread on first use.
+
+        @return False if the maximum number of clients has been reached, True otherwise. When True, the
+        client has to be served by `stream`, which unregisters it when the connection is closed.
+        """
+
+        with self.__condition:
+            if self.__clients >= self.__max_clients:
+                return False
+
+            self.__clients += 1
+
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__poll, name="publication-feed", daemon=True)
+                self.__thread.start()
+
+        return True
+
+
+    def stream(self, last_id:int):
+        """
+        The function `stream` yields the server-sent events of a connected client: one "published" event
+        for every publication after `last_id`, and a comment every few seconds to keep the connection open.
+
+        @param last_id The `last_id` parameter is the catalog version of the last publication known by the
+        client, e.g. from the Last-Event-ID header.
+
+        @return A generator of strings in the text/event-stream format.
+        """
+
+        try:
+            yield f"retry: {self.__heartbeat * 1000}\n\n"
+
+            while True:
+                with self.__condition:
+                    generation = self.__generation
+
+                events = catalog.get_events(last_id)
+                for event in events:
+                    last_id = event["id"]
+                    #Only the run names: the streams are open to the anonymous users
+                    data = {"id": event["id"], "runs": event["runs"], "removed": event.get("removed", [])}
+                    yield f"id: {event['id']}\nevent: published\ndata: {json.dumps(data)}\n\n"
+
+                with self.__condition:
+                    notified = self.__condition.wait_for(lambda: self.__generation != generation, timeout=self.__heartbeat)
+
+                if not notified:
+                    yield ": keep-alive\n\n"
+        finally:
+            with self.__condition:
+                self.__clients -= 1
+
+
+    def __notify(self, runs:set):
+        with self.__condition:
+            self.__generation += 1
+            self.__condition.notify_all()
+
+
+    def __poll(self):
+        while True:
+            time.sleep(self.__interval)
+
+            try:
+                if self.__clients:
+                    catalog.refresh(self.__models_path)
+            except Exception as e:
+                msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+                logging.error(msg)
+
+
+publication_feed = PublicationFeed()
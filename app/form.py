@@ -7,4 +7,19 @@ class login_form(FlaskForm):
     mail = EmailField("Mail", validators=[DataRequired()], id="mail", name="mail", render_kw={"placeholder": "Utente", "class":"form-control"})
     password = PasswordField("Password", validators=[DataRequired()],  id="password", name="password", render_kw={"placeholder": "Password", "class":"form-control"})
     submit = SubmitField("Autenticati", render_kw={"class":"btn btn-primary"})
-    
\ No newline at end of file
+    
+
+#########################################
+# LOGIN MODAL FORM                      #
+#########################################
+def login_modal_form() ->login_form:
+    """
+    The function `login_modal_form` builds the login form rendered in the modal of every page. The form
+    has no CSRF token, which would be written in the session of every visitor: the modal fetches it
+    from the "api/csrf-token" endpoint only when it is opened, so the pages seen by the anonymous
+    users do not touch the session.
+
+    @return The login form without CSRF protection, to be used only for rendering.
+    """
+
+    return login_form(meta={"csrf": False})
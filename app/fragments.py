@@ -0,0 +1,84 @@
+import threading
+from collections import OrderedDict
+from flask import Flask, get_template_attribute
+from markupsafe import Markup
+from app.catalog import catalog
+
+
+class FragmentCache(object):
+    """
+    It's a process-wide LRU cache of rendered HTML fragments with a budget in bytes.
+
+    The keys include the catalog version, and the whole cache is dropped as soon as
+    a new publication is noticed, so a fragment is never served after the content
+    it was rendered from has changed. Only the fragments that do not depend on the
+    single request (e.g. the card grids) should be cached: the CSRF token of the
+    login form and the flash messages are rendered around them on every request.
+    """
+
+    def __init__(self, max_bytes:int=0):
+        self.__lock = threading.Lock()
+        self.__fragments = OrderedDict()
+        self.__size = 0
+        self.max_bytes = max_bytes
+
+
+    def init_app(self, app:Flask):
+        """
+        The function `init_app` configures the budget of the cache and subscribes it to the
+        publications of the catalog.
+
+        @param app The `app` parameter is the Flask application object.
+        """
+
+        self.max_bytes = app.config["FRAGMENT_CACHE_BYTES"]
+        catalog.subscribe(lambda runs: self.clear())
+
+
+    def clear(self):
+        """
+        The function `clear` drops all the cached fragments.
+        """
+
+        with self.__lock:
+            self.__fragments.clear()
+            self.__size = 0
+
+
+    def render_macro(self, key:tuple, template:str, macro:str, *args) ->Markup:
+        """
+        The function `render_macro` returns a macro rendered with the given arguments, rendering it only
+        if it is not cached yet.
+
+        @param key The `key` parameter is a tuple identifying the fragment, e.g. the route, its
+        arguments and the authentication flag. The catalog version is added to it.
+        @param template The `template` parameter is the name of the template defining the macro.
+        @param macro The `macro` parameter is the name of the macro.
+        @param args The `args` parameters are passed to the macro.
+
+        @return The rendered fragment.
+        """
+
+        key = key + (catalog.version,)
+
+        with self.__lock:
+            if key in self.__fragments:
+                self.__fragments.move_to_end(key)
+                return self.__fragments[key][0]
+
+        fragment = Markup( get_template_attribute(template, macro)(*args) )
+        size = len( fragment.encode("utf-8") )
+
+        with self.__lock:
+            if size <= self.max_bytes and key not in self.__fragments:
+                self.__fragments[key] = (fragment, size)
+                self.__size += size
+
+                while self.__size > self.max_bytes:
+                    _, (_, evicted_size) = self.__fragments.popitem(last=False)
+                    self.__size -= evicted_size
+
+        return fragment
+
+
+fragment_cache = FragmentCache()
@@ -1,18 +1,16 @@
 from __future__ import with_statement
 import calendar
-import glob
-import json
 import logging
 import re
 import sys
 import unicodedata
-from os import listdir, path
 from urllib.parse import urljoin, urlparse
 from flask import request
 import gettext
 from datetime import datetime
 from dateutil import tz
-from pathlib import Path
+from app.catalog import catalog
+from app.images import parse_image_name
 
 
 #########################################
@@ -123,15 +121,15 @@ def convert_into_local_time(to_zone:str, utc:datetime) ->list:
 #########################################  
 def get_models(models_path:str, is_authenticated:bool, run_date:str) ->list:
     """
-    The function `get_models` retrieves a list of models from a specified path, filtering them based on
-    authentication status and a given run date.
+    The function `get_models` retrieves a list of models from the dashboard snapshot of a day, written at
+    ingest time, choosing the variant based on the authentication status.
     
     @param models_path The `models_path` parameter is a string that represents the path to the directory
     where the models are stored. This directory should contain subdirectories for each run date, and
     each subdirectory should contain JSON files representing the models.
     @param is_authenticated A boolean value indicating whether the user is authenticated or not.
     @param run_date The `run_date` parameter is a string representing the date in the format "YYYYMMDD".
-    It is used to construct the full path to the models directory by appending it to the `models_path`.
+    It is used to select the snapshot of that day.
 
     @return The function `get_models` returns a list. The first element of the list is a boolean value
     indicating whether the function executed successfully or not. The second element is a nested list
@@ -139,57 +137,14 @@ def get_models(models_path:str, is_authenticated:bool, run_date:str) ->list:
     """
 
     try:
-        full_models_path = path.join(models_path, run_date)
-
         month_name = calendar.month_name[ int(run_date[4:6]) ].title()
         string_date = f"{run_date[6:8]} {month_name} {run_date[0:4]}"
 
-        data = []
-
-        dir_list = glob.glob(full_models_path + "*/webp")
-        for dir in sorted(dir_list):
-    
-            models = []
-
-            json_files = [filename for filename in listdir(dir) if filename.endswith('.json')]
-            for json_file in sorted(json_files):
-
-                if path.exists( path.join(dir, json_file) ):
-                    with open( path.join(dir, json_file) ) as j:
-                            
-                        jdata = json.load(j)
-
-                        if is_authenticated or jdata["pubblico"]:
-                   
-                            model = {}
-
-                            if json_file.startswith("map_"):
-                                title = jdata["etichetta"].split("_")[1:]
+        variant = "authenticated" if is_authenticated else "public"
 
-                            if json_file.startswith("section_"):   
-                                title = jdata["etichetta"].split("_")
+        snapshot = catalog.get_snapshot(models_path, run_date)
+        data = [snapshot[run][variant] for run in sorted(snapshot)]
 
-                            title = [dir.title() for dir in title]
-                            model["title"] = ' '.join(title)
-
-                            if json_file.startswith("map_"):
-                                thumb_filepath = path.join(dir, "thumbs", "thumb_" + jdata["immagini"][0]["like"])
-              
-                            if json_file.startswith("section_"):
-                                thumb_filename = Path(jdata["immagini"][0]["file"]).with_suffix('')
-                                thumb_filepath = path.join(dir, "thumbs", "thumb_" + str(thumb_filename))
-                   
-                            thumbs = glob.glob( thumb_filepath + "*.webp" )
-                            model["thumbs"] = path.basename(thumbs[0]) if thumbs else ""
-
-                            model["dataEmissione"] = jdata["dataEmissione"]
-                            model["etichetta"] = jdata["etichetta"]
-                            model["percorso"] = jdata["percorso"]
-                            model["tags"] = [jdata["nomeModello"], jdata["tipo"]]
-
-                            models.append(model)
-    
-            data.append(models)
         result = [True, [[string_date], data]]
     except Exception as e:
         logging.error(repr(e))
@@ -201,16 +156,17 @@ def get_models(models_path:str, is_authenticated:bool, run_date:str) ->list:
 #########################################
 # GET VARIABLES                         #
 #########################################  
-def get_variables(models_path:str, is_authenticated:bool, name:str) ->list:
+def get_variables(models_path:str, is_authenticated:bool, run:str, name:str) ->list:
     """
     The function `get_variables` takes in a `models_path` (a string representing the path to a
-    directory), a `name` (a string representing a name), and an `is_authenticated` (a boolean
+    directory), a `run`, a `name` (a string representing a name), and an `is_authenticated` (a boolean
     representing whether the user is authenticated) and returns a list of variables.
     
     @param models_path The `models_path` parameter is a string that represents the path to the directory
     where the models are stored.
-    @param name The `name` parameter is a string that represents the name of a model.
     @param is_authenticated A boolean value indicating whether the user is authenticated or not.
+    @param run The `run` parameter is a string that represents the run directory of the model.
+    @param name The `name` parameter is a string that represents the name of a model.
 
     @return Returns a list containing two elements. The first element is a
     boolean value indicating the success or failure of the function, and the second element is a list of
@@ -218,53 +174,11 @@ def get_variables(models_path:str, is_authenticated:bool, name:str) ->list:
     """
 
     try:
-        variables = []
-
-        jfile = path.join(models_path, "webp", name + ".json")
+        model = get_catalog_model(models_path, run, name)
 
-        if path.exists( jfile ):
-            with open(jfile) as j:
-                data = json.load(j)
+        variables = model["variables"] if is_authenticated or model["pubblico"] else []
 
-                string_date = f'{data["percorso"][6:8]} {calendar.month_name[ int( data["percorso"][4:6] ) ].title()} {data["percorso"][0:4]}'
-                string_run = f'Corsa del {data["percorso"][8:10]} UTC'
-
-                images = data["immagini"] 
-
-                if is_authenticated or data["pubblico"]:
-                    for img in images:
-
-                        variable = {}
-
-                        if name.startswith("map_"):
-                            variable["title"] = img["title"]
-
-                            thumbs = glob.glob( path.join(models_path, "webp", "thumbs", "thumb_" + img["like"] + "*.webp") )
-                
-                        if name.startswith("section_"):
-                            variable["title"] = img["name"]
-                    
-                            thumb_filename = Path(img["file"]).with_suffix('')
-                            thumb_filepath = path.join(models_path, "webp", "thumbs", "thumb_" + str(thumb_filename))
-                            thumbs = glob.glob( thumb_filepath + "*.webp" )
-                         
-                        variable["thumbs"] = path.basename(thumbs[0]) if thumbs else ""
-                    
-                        variable["tags"] = [data["nomeModello"], data["tipo"]]
-                        variable["dataEmissione"] = data["dataEmissione"]
-                        variable["etichetta"] = data["etichetta"]
-
-                        if name.startswith("map_"):
-                            variable["variable"] = img["like"]
-
-                        if name.startswith("section_"):
-                            variable["variable"] = img["file"]
-
-                        variable["percorso"] = data["percorso"]
-
-                        variables.append(variable)
-
-        result = [True, [[string_date, string_run], variables]]
+        result = [True, [[model["string_date"], model["string_run"]], variables]]
     except Exception as e:
         logging.error(repr(e))
         result = [False, repr(e)]
@@ -272,15 +186,19 @@ def get_variables(models_path:str, is_authenticated:bool, name:str) ->list:
     return result  
 
 
-def get_variable_images(models_path:str, is_authenticated:bool, name:str, variable:str) ->list:
+#########################################
+# GET VARIABLE IMAGES                   #
+#########################################  
+def get_variable_images(models_path:str, is_authenticated:bool, run:str, name:str, variable:str) ->list:
     """
-    The function `get_variable_images` retrieves a list of images based on a given variable name from a
-    JSON file, along with additional information such as the date and run details, and returns the
+    The function `get_variable_images` retrieves from the catalog index the list of images of a given
+    variable, along with additional information such as the date and run details, and returns the
     result as a list.
     
     @param models_path The `models_path` parameter is a string that represents the path to the directory
     where the models are stored.
     @param is_authenticated A boolean value indicating whether the user is authenticated or not.
+    @param run The `run` parameter is a string that represents the run directory of the model.
     @param name The `name` parameter is a string that represents the name of the model.
     @param variable The `variable` parameter is a string that represents a specific variable. It is used
     to filter the images based on this variable.
@@ -288,46 +206,69 @@ def get_variable_images(models_path:str, is_authenticated:bool, name:str, variab
     @return The function `get_variable_images` returns a list. The first element of the list indicates
     whether the operation was successful or not. If the operation was successful, the second element of
     the list contains a nested list. The nested list contains three elements: `string_date`,
-    `string_run`, and `string_variable`. The fourth element of the nested list is a list of file names.
+    `string_run`, and `string_variable`. The fourth element of the nested list is a list of file names
+    and the last one is the animation of the variable, a dictionary with the "file", the "timestamps" of
+    the frames and their "duration", or None if the animation has not been built. A PermissionError is
+    raised if the model is restricted and the user is not authenticated.
     """
 
     try:
-        jfile = path.join(models_path, "webp", name + ".json")
-
-        if path.exists( jfile ):
-            with open(jfile) as j:
-                data = json.load(j)
-
-                if name.startswith("section_"):
-                    images = data["immagini"]
-                    for e in images:
-                        for i,v in e.items():
-                            if v == variable:
-                                string_variable = e["name"]
-    
-                    string_date = f'{data["percorso"][6:8]} {calendar.month_name[ int( data["percorso"][4:6] ) ].title()} {data["percorso"][0:4]}'
-                    string_run = f'Corsa del {data["percorso"][8:10]} UTC'
-
-                    if is_authenticated or data["pubblico"]:   
-                        v= Path(variable).with_suffix('')
-                        list_of_files = [path.basename(x) for x in glob.glob( path.join(models_path, "webp", str(v) + "*.webp") )]
-                    
-                if name.startswith("map_"):
-                        images = data["immagini"]
-                        for e in images:
-                            for i,v in e.items():
-                                if v == variable:
-                                    string_variable = e["title"]
-        
-                        string_date = f'{data["percorso"][6:8]} {calendar.month_name[ int( data["percorso"][4:6] ) ].title()} {data["percorso"][0:4]}'
-                        string_run = f'Corsa del {data["percorso"][8:10]} UTC'
-
-                        if is_authenticated or data["pubblico"]:   
-                            list_of_files = [path.basename(x) for x in glob.glob( path.join(models_path, "webp", variable + "*.webp") )]
-
-                result = [True,[[string_date, string_run, string_variable], list_of_files]]
+        model = get_catalog_model(models_path, run, name)
+
+        if not (is_authenticated or model["pubblico"]):
+            raise PermissionError(f"Model {run}/{name} is not public")
+
+        images = model["images"][variable]
+
+        result = [True,[[model["string_date"], model["string_run"], images["title"]], images["files"], images["animation"]]]
+    except PermissionError:
+        raise
     except Exception as e:
         logging.error(repr(e))
         result = [False, repr(e)]
 
-    return result  
\ No newline at end of file
+    return result
+
+
+#########################################
+# GET CATALOG MODEL                     #
+#########################################  
+def get_catalog_model(models_path:str, run:str, name:str) ->dict:
+    """
+    The function `get_catalog_model` returns a single model from the catalog index.
+    
+    @param models_path The `models_path` parameter is a string that represents the path to the directory
+    where the models are stored.
+    @param run The `run` parameter is a string that represents the run directory of the model.
+    @param name The `name` parameter is a string that represents the name of the model.
+
+    @return The indexed model. A `LookupError` is raised if the run or the model do not exist.
+    """
+
+    indexed_run = catalog.get_run(models_path, run)
+    if indexed_run is None or name not in indexed_run["models"]:
+        raise LookupError(f"Model {run}/{name} not found")
+
+    return indexed_run["models"][name]
+
+
+#########################################
+# GET IMAGE VISIBILITY                  #
+#########################################  
+def get_image_visibility(indexed_run:dict, filename:str):
+    """
+    The function `get_image_visibility` tells if a frame or thumbnail of a run belongs to a public model.
+    The check is a lookup in the visibility map precomputed by the catalog index, without reading any file.
+    
+    @param indexed_run The `indexed_run` parameter is the catalog index of the run, see `index_run`.
+    @param filename The `filename` parameter is the path of the image inside the webp directory of the
+    run, e.g. "t2m_000.webp", "thumbs/thumb_t2m_000.webp", "sizes/t2m_000_640w.webp" or
+    "animations/t2m_.webp".
+
+    @return True if the image belongs to at least one public model, False if it belongs only to
+    restricted models, None if it does not belong to any published model.
+    """
+
+    frame, _ = parse_image_name(filename)
+
+    return indexed_run["visibility"].get(frame)
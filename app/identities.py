@@ -0,0 +1,112 @@
+import threading
+import time
+from flask import Flask
+from flask_login import UserMixin
+from sqlalchemy import event
+from app.database import db
+
+
+class Identity(UserMixin):
+    """
+    It's the identity of an authenticated user as seen by the views: a plain copy of the
+    columns needed by the requests, detached from any database session.
+    """
+
+    def __init__(self, id:int, mail:str):
+        self.id = id
+        self.mail = mail
+
+
+class IdentityCache(object):
+    """
+    It's a process-wide cache of the identities loaded by Flask-Login, so that the
+    authenticated requests do not query the users table on every page.
+
+    An identity is kept for at most IDENTITY_CACHE_SECONDS seconds. The changes made by
+    this process to a user drop its identity at once, while the changes made by other
+    processes (e.g. the other web server workers or the CLI) are seen when it expires.
+    """
+
+    def __init__(self, ttl:float=0):
+        self.__lock = threading.Lock()
+        self.__identities = {}
+        self.ttl = ttl
+
+
+    def init_app(self, app:Flask):
+        """
+        The function `init_app` configures the time to live of the identities and subscribes the cache to
+        the changes of the users. It must be called after the models are imported.
+
+        @param app The `app` parameter is the Flask application object.
+        """
+
+        from app.models import Users
+
+        self.ttl = app.config["IDENTITY_CACHE_SECONDS"]
+
+        for identifier in ("after_insert", "after_update", "after_delete"):
+            event.listen(Users, identifier, lambda mapper, connection, user: self.invalidate(user.id))
+
+
+    def invalidate(self, user_id):
+        """
+        The function `invalidate` drops the cached identity of a user.
+
+        @param user_id The `user_id` parameter is the id of the user.
+        """
+
+        with self.__lock:
+            self.__identities.pop(str(user_id), None)
+
+
+    def clear(self):
+        """
+        The function `clear` drops all the cached identities.
+        """
+
+        with self.__lock:
+            self.__identities.clear()
+
+
+    def load(self, user_id:str):
+        """
+        The function `load` returns the identity of a user, querying the database only if it is not
+        cached or it has expired.
+
+        @param user_id The `user_id` parameter is the id of the user, as stored in the session.
+
+        @return The `Identity` of the user, or None if the user does not exist.
+        """
+
+        now = time.monotonic()
+
+        with self.__lock:
+            cached = self.__identities.get(user_id)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+
+        from app.models import Users
+
+        try:
+            user = db.session.get(Users, int(user_id))
+        except ValueError:
+            return None
+
+        if user is None:
+            self.invalidate(user_id)
+            return None
+
+        identity = Identity(user.id, user.mail)
+
+        with self.__lock:
+            self.__identities[user_id] = (now + self.ttl, identity)
+
+            #Expired identities of the users who are no longer active are dropped here, the users are few
+            for key in [ key for key, (expiry, _) in self.__identities.items() if expiry <= now ]:
+                del self.__identities[key]
+
+        return identity
+
+
+identity_cache = IdentityCache()
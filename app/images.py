@@ -0,0 +1,257 @@
+import json
+import re
+import shutil
+from os import getpid, makedirs, path, remove, replace
+from PIL import Image
+from app.blobs import BLOB_FRAME, BLOB_THUMB, blob_key, blob_path, link_blob, store_blob
+
+
+#The smaller renditions of a frame live in webp/sizes, e.g. sizes/t2m_000_640w.webp
+RENDITIONS_DIRNAME = "sizes"
+RENDITION_PATTERN = re.compile(r"^(.+)_(\d+)w\.webp$")
+
+#The animated WebP of every variable lives in webp/animations, named after the prefix of its frames
+ANIMATIONS_DIRNAME = "animations"
+
+
+#########################################
+# RENDITION NAME                        #
+#########################################
+def rendition_name(frame:str, width:int) ->str:
+    """
+    The function `rendition_name` returns the file name of a rendition of a frame.
+
+    @param frame The `frame` parameter is the file name of the full-size WebP frame.
+    @param width The `width` parameter is the width of the rendition in pixels.
+
+    @return The file name of the rendition, inside the renditions directory.
+    """
+
+    return f"{path.splitext(frame)[0]}_{width}w.webp"
+
+
+#########################################
+# PARSE RENDITION NAME                  #
+#########################################
+def parse_rendition_name(name:str):
+    """
+    The function `parse_rendition_name` is the inverse of `rendition_name`.
+
+    @param name The `name` parameter is the file name of a rendition.
+
+    @return A tuple with the file name of the full-size frame and the width of the rendition, or None if
+    the name is not a rendition.
+    """
+
+    match = RENDITION_PATTERN.match(name)
+    if match is None:
+        return None
+
+    return (match.group(1) + ".webp", int(match.group(2)))
+
+
+#########################################
+# PARSE IMAGE NAME                      #
+#########################################
+def parse_image_name(filename:str) ->tuple:
+    """
+    The function `parse_image_name` resolves an image of the webp directory of a run to its frame and to
+    the name of the same image inside the blob of the frame.
+
+    @param filename The `filename` parameter is the path of the image inside the webp directory, e.g.
+    "t2m_000.webp", "thumbs/thumb_t2m_000.webp" or "sizes/t2m_000_640w.webp".
+
+    @return A tuple with the file name of the frame and the name of the image in the blob, or with the
+    file name itself and None if the image is not stored in a blob, e.g. an animation.
+    """
+
+    if filename.startswith("thumbs/thumb_"):
+        return (filename[len("thumbs/thumb_"):], BLOB_THUMB)
+
+    if filename.startswith(RENDITIONS_DIRNAME + "/"):
+        rendition = parse_rendition_name(filename[len(RENDITIONS_DIRNAME + "/"):])
+        if rendition is not None:
+            return (rendition[0], f"{rendition[1]}w.webp")
+        return (filename, None)
+
+    if "/" not in filename and filename.endswith(".webp"):
+        return (filename, BLOB_FRAME)
+
+    return (filename, None)
+
+
+#########################################
+# PREPARE IMAGE                         #
+#########################################
+def prepare_image(image:Image.Image, profile:dict) ->tuple:
+    """
+    The function `prepare_image` applies the alpha handling of an encoder profile to a decoded image
+    and returns the options of the WebP encoder.
+
+    @param image The `image` parameter is the decoded image.
+    @param profile The `profile` parameter is a dictionary with the encoder settings: "lossless", a
+    boolean or "palette" to encode losslessly only the palette images, "quality", "method",
+    "alpha_quality" and "alpha", either "keep" or "flatten" to compose the image on a white background
+    and drop the alpha channel. Missing settings keep the Pillow defaults.
+
+    @return A tuple with the image to encode and the dictionary of the options of `Image.save`.
+    """
+
+    profile = profile or {}
+
+    if profile.get("alpha") == "flatten" and image.mode in ("RGBA", "LA", "P"):
+        rgba = image.convert("RGBA")
+        flat = Image.new("RGB", rgba.size, (255, 255, 255))
+        flat.paste(rgba, mask=rgba.getchannel("A"))
+        image = flat
+
+    options = {"format": "webp"}
+    for key in ("lossless", "quality", "method", "alpha_quality"):
+        if key in profile:
+            options[key] = profile[key]
+
+    #Few flat colours compress far better without losses, the antialiased images the other way round
+    if options.get("lossless") == "palette":
+        options["lossless"] = image.mode == "P"
+
+    return (image, options)
+
+
+#########################################
+# CONVERT PNG                           #
+#########################################
+def convert_png(png:str, destination:str, thumb_destination:str, size:tuple, staging_dir:str, blobs_dir:str, renditions:dict=None, profile:dict=None, delete_origin:bool=False) ->tuple:
+    """
+    The function `convert_png` converts a single PNG image into a full-size WebP image, a WebP
+    thumbnail and smaller renditions of the full-size image. The PNG is decoded only once and all the
+    outputs are derived from the same decoded image. It is a module level function so that it can be
+    run by the workers of a process pool.
+
+    The outputs are content-addressed: they are encoded once into a blob of the shared store, keyed by
+    the hash of the PNG and of the encoder settings, and hardlinked into the run. A frame identical to
+    one of a previous run is not encoded again and does not take any more space. The blob is built in
+    the staging directory and the outputs are linked into place, the full-size image last, so that a
+    reader never finds a partially written image.
+
+    @param png The `png` parameter is a string that represents the path of the image to convert.
+    @param destination The `destination` parameter is a string that represents the path of the
+    full-size WebP image.
+    @param thumb_destination The `thumb_destination` parameter is a string that represents the path of
+    the WebP thumbnail.
+    @param size The `size` parameter is a tuple that specifies the desired dimensions of the thumbnail
+    image. It should be in the format `(width, height)`.
+    @param staging_dir The `staging_dir` parameter is a string that represents the directory where the
+    outputs are written before being published. It must be on the same filesystem of the destinations
+    and of the blob store.
+    @param blobs_dir The `blobs_dir` parameter is a string that represents the path of the blob store.
+    @param renditions The `renditions` parameter is a dictionary mapping the width of every rendition to
+    its path. Only the renditions narrower than the image are created.
+    @param profile The `profile` parameter is the encoder profile used for all the outputs, see
+    `prepare_image`.
+    @param delete_origin The `delete_origin` parameter is a boolean flag that determines whether or not
+    to delete the original image file once both the outputs exist.
+
+    @return A tuple with the number of files written, the key of the blob, None if all the outputs
+    already existed, and True if all the outputs written have been linked to the blob, False if some
+    have been copied and the frame must not be served from the blob.
+    """
+
+    written = 0
+    key = None
+    linked = True
+
+    renditions = renditions or {}
+
+    #The full-size image is published last
+    outputs = [(f"{w}w.webp", d) for w, d in sorted(renditions.items())] + [(BLOB_THUMB, thumb_destination), (BLOB_FRAME, destination)]
+    missing = [(name, d) for name, d in outputs if not path.exists(d)]
+
+    if missing:
+        key = blob_key(png, {"size": list(size), "renditions": sorted(renditions), "profile": profile})
+        blob = blob_path(blobs_dir, key)
+
+        if not path.isdir(blob):
+            #Identical frames of the same run may be converted at the same time by different workers
+            staged_blob = path.join(staging_dir, f"{key}.{getpid()}")
+            shutil.rmtree(staged_blob, ignore_errors=True)
+            makedirs(staged_blob)
+
+            with Image.open(png) as source:
+                source.load()
+                image, options = prepare_image(source, profile)
+
+                for width in sorted(renditions):
+                    if width >= image.width:
+                        continue
+
+                    rendition = image.resize((width, max(1, round(image.height * width / image.width))), Image.Resampling.LANCZOS)
+                    rendition.save(path.join(staged_blob, f"{width}w.webp"), **options)
+
+                thumb = image.copy()
+                thumb.thumbnail(size, Image.Resampling.LANCZOS)
+                thumb.save(path.join(staged_blob, BLOB_THUMB), **options)
+
+                image.save(path.join(staged_blob, BLOB_FRAME), **options)
+
+            store_blob(staged_blob, blob)
+
+        for name, final_file in missing:
+            if path.exists(path.join(blob, name)):
+                linked = link_blob(path.join(blob, name), final_file, staging_dir) and linked
+                written += 1
+
+    if delete_origin:
+        if path.exists(destination) and path.exists(thumb_destination):
+            remove(png)
+
+    return (written, key, linked)
+
+
+#########################################
+# BUILD ANIMATION                       #
+#########################################
+def build_animation(frames:list, destination:str, index_destination:str, index:dict, staging_dir:str, profile:dict=None, max_width:int=0) ->int:
+    """
+    The function `build_animation` assembles the WebP frames of a variable into a single animated WebP,
+    so that a whole forecast can be played with one request. All the frames are kept in memory until the
+    animation is encoded, so the wider ones are scaled down to `max_width` as soon as they are decoded.
+    It is a module level function so that it can be run by the workers of a process pool.
+
+    The animation is written in the staging directory and renamed into place, then its index is
+    published the same way: a reader that finds the index always finds the complete animation.
+
+    @param frames The `frames` parameter is the list of the paths of the frames, in playback order.
+    @param destination The `destination` parameter is the path of the animated WebP.
+    @param index_destination The `index_destination` parameter is the path of the JSON index.
+    @param index The `index` parameter is the dictionary written as index: the frame names, their
+    timestamps and the "duration" of every frame in milliseconds.
+    @param staging_dir The `staging_dir` parameter is the directory where the outputs are written before
+    being published.
+    @param profile The `profile` parameter is the encoder profile, see `prepare_image`.
+    @param max_width The `max_width` parameter is the maximum width of the frames, 0 for no limit.
+
+    @return The number of frames of the animation.
+    """
+
+    images = []
+    for frame in frames:
+        with Image.open(frame) as source:
+            source.load()
+            image, options = prepare_image(source.convert("RGBA") if source.mode not in ("RGB", "RGBA") else source, profile)
+
+            if max_width and image.width > max_width:
+                image = image.resize((max_width, max(1, round(image.height * max_width / image.width))), Image.Resampling.LANCZOS)
+
+            images.append(image)
+
+    staged_destination = path.join(staging_dir, path.basename(destination))
+    images[0].save(staged_destination, save_all=True, append_images=images[1:], duration=index["duration"], loop=0, **options)
+
+    staged_index = path.join(staging_dir, path.basename(index_destination))
+    with open(staged_index, "w") as outfile:
+        json.dump(index, outfile)
+
+    replace(staged_destination, destination)
+    replace(staged_index, index_destination)
+
+    return len(images)
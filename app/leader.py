@@ -0,0 +1,52 @@
+import logging
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+#The lock files are kept open for the whole life of the process: closing them releases the lock
+_locks = {}
+
+
+#########################################
+# ACQUIRE LEADER LOCK                   #
+#########################################
+def acquire_leader_lock(lock_file:str) ->bool:
+    """
+    The function `acquire_leader_lock` tries to take an exclusive, non-blocking lock on a file, so that
+    only one process per host is elected as leader. The lock is released by the operating system when
+    the process exits, so a new leader can be elected when the current one dies.
+
+    @param lock_file The `lock_file` parameter is a string that represents the path of the lock file.
+
+    @return Returns True if the current process holds the lock, False otherwise.
+    """
+
+    if lock_file in _locks:
+        return True
+
+    f = open(lock_file, "a+")
+    try:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        f.close()
+        return False
+
+    if fcntl:
+        f.seek(0)
+        f.truncate()
+        f.write(str(os.getpid()))
+        f.flush()
+
+    _locks[lock_file] = f
+    logging.info(f"Process {os.getpid()} elected as leader ({lock_file})")
+
+    return True
@@ -0,0 +1,207 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import bcrypt
+from flask import Flask
+
+
+class PasswordVerifier(object):
+    """
+    It's the per-process pool hashing and checking the passwords with bcrypt.
+
+    At most LOGIN_VERIFY_WORKERS passwords are hashed at once by every web server worker,
+    and at most LOGIN_VERIFY_QUEUE logins wait for their turn: the others are refused at
+    once. bcrypt releases the GIL, so a burst of logins takes a bounded share of the CPU
+    and the other threads of the worker keep serving the model views.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__executor = None
+        self.__slots = None
+        self.workers = 1
+        self.timeout = 10
+        self.rounds = 12
+
+
+    def init_app(self, app:Flask):
+        """
+        The function `init_app` configures the pool and the bcrypt cost factor.
+
+        @param app The `app` parameter is the Flask application object.
+        """
+
+        self.workers = app.config["LOGIN_VERIFY_WORKERS"]
+        self.timeout = app.config["LOGIN_VERIFY_TIMEOUT"]
+        self.rounds = app.config["BCRYPT_ROUNDS"]
+        self.__slots = threading.BoundedSemaphore(self.workers + app.config["LOGIN_VERIFY_QUEUE"])
+
+
+    def verify(self, password:str, hashed):
+        """
+        The function `verify` checks a password against its bcrypt hash.
+
+        @param password The `password` parameter is the password typed by the user.
+        @param hashed The `hashed` parameter is the bcrypt hash stored for the user.
+
+        @return True if the password matches, False if it does not, None if the pool is busy.
+        """
+
+        return self.__submit(bcrypt.checkpw, password.encode("utf-8"), self.__bytes(hashed))
+
+
+    def hash(self, password:str):
+        """
+        The function `hash` hashes a password with the configured cost factor.
+
+        @param password The `password` parameter is the password to hash.
+
+        @return The bcrypt hash, or None if the pool is busy.
+        """
+
+        return self.__submit(lambda p: bcrypt.hashpw(p, bcrypt.gensalt(rounds=self.rounds)), password.encode("utf-8"))
+
+
+    def needs_rehash(self, hashed) ->bool:
+        """
+        The function `needs_rehash` tells if a hash has been computed with a cost factor different from
+        BCRYPT_ROUNDS, e.g. before it was changed.
+
+        @param hashed The `hashed` parameter is the bcrypt hash stored for the user.
+
+        @return True if the password should be hashed again.
+        """
+
+        try:
+            return int( self.__bytes(hashed).split(b"$")[2] ) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+    def __bytes(self, hashed) ->bytes:
+        return hashed.encode("utf-8") if isinstance(hashed, str) else hashed
+
+
+    def __submit(self, function, *args):
+        if not self.__slots.acquire(blocking=False):
+            logging.warning("Password verification pool busy: login refused")
+            return None
+
+        try:
+            with self.__lock:
+                #Created on first use, the threads of the pool would not survive the fork of the workers
+                if self.__executor is None:
+                    self.__executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+
+            future = self.__executor.submit(function, *args)
+        except Exception:
+            self.__slots.release()
+            raise
+
+        future.add_done_callback(lambda f: self.__slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            logging.warning("Password verification timed out: login refused")
+            return None
+
+
+class LoginRateLimiter(object):
+    """
+    It's the per-process limit of the login attempts: at most LOGIN_RATE_LIMIT_IP attempts from
+    the same IP and LOGIN_RATE_LIMIT_ACCOUNT failed attempts on the same account every
+    LOGIN_RATE_WINDOW seconds. A successful login clears the failures of the account.
+
+    The counters are kept by every web server worker, so the limits of the whole host are
+    the configured ones times the number of workers.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.window = 300
+        self.limit_ip = 0
+        self.limit_account = 0
+        self.max_keys = 10000
+
+
+    def init_app(self, app:Flask):
+        """
+        The function `init_app` configures the window and the limits.
+
+        @param app The `app` parameter is the Flask application object.
+        """
+
+        self.window = app.config["LOGIN_RATE_WINDOW"]
+        self.limit_ip = app.config["LOGIN_RATE_LIMIT_IP"]
+        self.limit_account = app.config["LOGIN_RATE_LIMIT_ACCOUNT"]
+
+
+    def check(self, remote_addr:str, mail:str) ->int:
+        """
+        The function `check` counts a login attempt from an IP and tells if it can go on.
+
+        @param remote_addr The `remote_addr` parameter is the IP of the user.
+        @param mail The `mail` parameter is the account of the attempt.
+
+        @return 0 if the attempt is allowed, otherwise the seconds until the next attempt is allowed.
+        """
+
+        now = time.monotonic()
+
+        with self.__lock:
+            ip_start, ip_count = self.__hit(("ip", remote_addr), now)
+            account_start, account_count = self.__counters.get(("account", mail), (now, 0))
+
+            retry_after = 0
+            if self.limit_ip and ip_count > self.limit_ip:
+                retry_after = ip_start + self.window - now
+            if self.limit_account and account_count >= self.limit_account and account_start + self.window > now:
+                retry_after = max(retry_after, account_start + self.window - now)
+
+        return int(retry_after) + 1 if retry_after > 0 else 0
+
+
+    def failure(self, mail:str):
+        """
+        The function `failure` counts a failed login on an account.
+
+        @param mail The `mail` parameter is the account of the attempt.
+        """
+
+        with self.__lock:
+            self.__hit(("account", mail), time.monotonic())
+
+
+    def success(self, mail:str):
+        """
+        The function `success` clears the failed logins of an account.
+
+        @param mail The `mail` parameter is the account of the attempt.
+        """
+
+        with self.__lock:
+            self.__counters.pop(("account", mail), None)
+
+
+    def __hit(self, key:tuple, now:float) ->tuple:
+        start, count = self.__counters.pop(key, (now, 0))
+        if start + self.window <= now:
+            start, count = now, 0
+
+        #The counters are kept in order of last use, the least recently used go first when too many
+        self.__counters[key] = (start, count + 1)
+
+        if len(self.__counters) > self.max_keys:
+            for expired in [ k for k, (s, _) in self.__counters.items() if s + self.window <= now ]:
+                del self.__counters[expired]
+            while len(self.__counters) > self.max_keys:
+                del self.__counters[next(iter(self.__counters))]
+
+        return self.__counters[key]
+
+
+password_verifier = PasswordVerifier()
+login_rate_limiter = LoginRateLimiter()
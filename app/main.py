@@ -1,15 +1,22 @@
 from __future__ import with_statement
-import json
+import mimetypes
 from os import path
-from flask import Blueprint, abort, current_app, jsonify, render_template, flash, request, redirect, url_for, send_from_directory
+from urllib.parse import quote
+from flask import Blueprint, Response, abort, current_app, g, jsonify, render_template, flash, request, redirect, session, url_for, send_from_directory
 from flask_login import current_user
 from jinja2 import TemplateNotFound
-from app.form import login_form
-from app.functions import get_models, get_variables, get_variable_images, convert_into_local_time
-import glob
+from app.catalog import catalog
+from app.events import publication_feed
+from app.form import login_modal_form
+from app.fragments import fragment_cache
+from app.archive import read_archived_file
+from app.blobs import BLOBS_DIRNAME, BLOB_KEY_PATTERN
+from app.images import parse_image_name
+from app.functions import get_models, get_variables, get_variable_images, get_image_visibility, convert_into_local_time
 from datetime import datetime
 import logging
 from markupsafe import escape
+from werkzeug.security import safe_join
 
 
 
@@ -19,6 +26,116 @@ BASEDIR = path.abspath( path.dirname(__file__) )
 main = Blueprint('main', __name__)
 
 
+def get_request_run(run:str):
+    """
+    The function `get_request_run` returns the catalog index of a run, looked up only once per request:
+    a gallery builds the URLs of many images of the same run, and every lookup of the catalog checks
+    the stamp file of the publications.
+
+    @param run The `run` parameter is a string that represents the run directory.
+
+    @return The indexed run, see `index_run`, or None if the run does not exist.
+    """
+
+    runs = g.setdefault("indexed_runs", {})
+    if run not in runs:
+        MODELS_PATH = path.join(BASEDIR, *current_app.config["MODELS_PATH"])
+        runs[run] = catalog.get_run(MODELS_PATH, run)
+
+    return runs[run]
+
+
+@main.app_template_global()
+def model_image_url(run:str, filename:str) ->str:
+    """
+    The function `model_image_url` builds the URL of a WebP frame or thumbnail of a run, served by the
+    `model_image` route. The images of the public frames stored in a blob are addressed by their content
+    instead, through the `model_blob` route, so that a frame that does not change between the runs is
+    downloaded and cached by the browsers only once. The URL of an animation carries its version, which
+    changes when the animation is rebuilt with new frames. It is available in every template.
+
+    @param run The `run` parameter is a string that represents the run directory.
+    @param filename The `filename` parameter is the path of the image inside the webp directory of the
+    run, e.g. "t2m_000.webp", "thumbs/thumb_t2m_000.webp" or "animations/t2m_.webp".
+
+    @return The URL of the image.
+    """
+
+    indexed_run = get_request_run(run)
+    if indexed_run is not None:
+        frame, name = parse_image_name(filename)
+        key = indexed_run["blobs"].get(frame)
+
+        #The key of a restricted frame is never disclosed, its images are served only by `model_image`
+        if name is not None and key is not None and indexed_run["visibility"].get(frame):
+            return url_for('main.model_blob', key=key, name=name)
+
+        version = indexed_run["versions"].get(filename)
+        if version is not None:
+            return url_for('main.model_image', run=run, filename=filename, v=version)
+
+    return url_for('main.model_image', run=run, filename=filename)
+
+
+@main.app_template_global()
+def model_image_srcset(run:str, frame:str) ->str:
+    """
+    The function `model_image_srcset` builds the srcset attribute of a WebP frame, listing its smaller
+    renditions, its thumbnail and the full-size image with their widths, so that every browser downloads
+    the smallest adequate image. It is available in every template.
+
+    @param run The `run` parameter is a string that represents the run directory.
+    @param frame The `frame` parameter is the file name of the full-size frame, e.g. "t2m_000.webp".
+
+    @return The srcset attribute, or an empty string if the frame has no renditions.
+    """
+
+    indexed_run = get_request_run(run)
+    if indexed_run is None or frame not in indexed_run["widths"]:
+        return ""
+
+    return ", ".join( f"{model_image_url(run, filename)} {width}w" for width, filename in indexed_run["widths"][frame] )
+
+
+@main.after_request
+def cache_anonymous_pages(response:Response) ->Response:
+    """
+    The function `cache_anonymous_pages` lets the browsers and the shared caches keep the pages of the
+    model views seen without a session. They are the same for all the anonymous users, since they have
+    no flash messages and no CSRF token, while the pages of the authenticated users are never shared
+    thanks to the Vary header. The pages change as soon as a run is published, so they are revalidated
+    at every use with an ETag computed from their content and a conditional request is answered with 304.
+
+    @param response The `response` parameter is the response of the view.
+
+    @return The response.
+    """
+
+    if request.method == "GET" and response.status_code == 200 and response.mimetype == "text/html":
+        response.vary.add("Cookie")
+        if not session and not session.modified and not response.cache_control and not response.is_streamed:
+            response.cache_control.public = True
+            response.cache_control.no_cache = True
+            response.add_etag()
+            response.make_conditional(request)
+
+    return response
+
+
+@main.before_app_request
+def protect_models_static():
+    """
+    The function `protect_models_static` prevents the models directory from being served as static
+    files: the images are served only by the `model_image` route, which enforces the access rules.
+    """
+
+    if request.endpoint == "static" and request.view_args:
+        MODELS_PATH = path.join(BASEDIR, *current_app.config["MODELS_PATH"])
+        static_file = path.abspath( path.join(current_app.static_folder, request.view_args.get("filename", "")) )
+        if static_file == MODELS_PATH or static_file.startswith(MODELS_PATH + path.sep):
+            abort(404)
+
+
 @main.route("/")
 def index():
     """
@@ -57,6 +174,9 @@ def dashboard(day:str):
 
         if not data[0]:
             flash("Errore nel caricamento dei modelli", "danger")
+            cards = ""
+        else:
+            cards = fragment_cache.render_macro(("dashboard", str(day), is_authenticated), "macros.html", "create_models_cards", data[1], "main.variables_overview")
 
         return render_template(
             "dashboard.html", 
@@ -65,7 +185,8 @@ def dashboard(day:str):
             title="Cruscotto", 
             sidebar = "dashboard",
             data=data[1], 
-            form = login_form(),
+            cards=cards,
+            form = login_modal_form(),
             url="main.variables_overview"
         )
     except TemplateNotFound:
@@ -92,11 +213,14 @@ def variables_overview(run:str, name:str):
         name = escape(name)
 
         is_authenticated = current_user.is_authenticated
-        MODEL_PATH = path.join(BASEDIR, *current_app.config["MODELS_PATH"], run)
+        MODELS_PATH = path.join(BASEDIR, *current_app.config["MODELS_PATH"])
 
-        data = get_variables(MODEL_PATH, is_authenticated, name)
+        data = get_variables(MODELS_PATH, is_authenticated, run, name)
         if not data[0]:
             flash("Errore nel caricamento dei modelli", "danger")
+            cards = ""
+        else:
+            cards = fragment_cache.render_macro(("variables_overview", str(run), str(name), is_authenticated), "macros.html", "create_variables_cards", data[1], "main.variable_images")
 
         title = name.split("_")
         title = [e.title() for e in title]
@@ -108,8 +232,9 @@ def variables_overview(run:str, name:str):
             base_href = current_app.config["APPLICATION_ROOT"],
             title="Panoramica variabili del modello " + title, 
             data=data[1],
+            cards=cards,
             sidebar = "variables_overview",
-            form = login_form(), 
+            form = login_modal_form(), 
             url='main.variable_images'
         )   
     except TemplateNotFound:
@@ -129,6 +254,9 @@ def variable_images(run:str, name:str, variable:str):
     to retrieve images. It is used in the `get_variable_images` function to fetch the images related to
     that variable.
     
+    With the "mode=animation" query parameter, the animated WebP of the variable is shown instead of the
+    gallery, so the whole forecast is played with a single request.
+    
     @return a rendered template called 'variable_images.html'. The template is being passed several
     variables including 'display_name', 'base_href', 'title', 'run', 'data', 'sidebar', and 'form'.
     """
@@ -136,11 +264,17 @@ def variable_images(run:str, name:str, variable:str):
     try:
 
         is_authenticated = current_user.is_authenticated
-        MODEL_PATH = path.join(BASEDIR, *current_app.config["MODELS_PATH"], run)
+        MODELS_PATH = path.join(BASEDIR, *current_app.config["MODELS_PATH"])
 
-        data = get_variable_images(MODEL_PATH, is_authenticated, name, variable)
+        #The restricted models are refused like their images, the missing ones have no page to show
+        try:
+            data = get_variable_images(MODELS_PATH, is_authenticated, run, name, variable)
+        except PermissionError:
+            abort(403)
         if not data[0]:
-            flash("Errore nel caricamento dei modelli", "danger")
+            abort(404)
+
+        animation = data[1][2] is not None and request.args.get("mode") == "animation"
 
         title = name.split("_")[1:]
         title = [e.title() for e in title]
@@ -152,14 +286,220 @@ def variable_images(run:str, name:str, variable:str):
             base_href = current_app.config["APPLICATION_ROOT"],
             title = "Immagini per " + data[1][0][2] + " del modello " + title, 
             run=run,
+            name=name,
+            variable=variable,
+            animation=animation,
             data=data[1],
             sidebar = "variable_images",
-            form = login_form()
+            form = login_modal_form()
         )   
     except TemplateNotFound:
         abort(404)
 
  
+@main.route('/images/<run>/<path:filename>')
+def model_image(run:str, filename:str):
+    """
+    The function `model_image` serves the WebP frames and thumbnails of a run. Once published they never
+    change, so they are cached by the browsers as immutable and a conditional request is answered with
+    304 without touching the file. Range requests are supported.
+
+    The animations are rebuilt in place when frames are added to the run, so their entity tag carries
+    their version and they are immutable only when requested with the current version in the "v" query
+    parameter, otherwise the browsers revalidate them.
+
+    The images of the restricted models are served only to the authenticated users. When MODELS_SENDFILE
+    is set, the view only authorizes and resolves the image and the transfer of the bytes is delegated to
+    the front proxy, so that the web server workers are not tied up by the downloads.
+
+    @param run The `run` parameter is a string that represents the run directory.
+    @param filename The `filename` parameter is the path of the image inside the webp directory of the
+    run.
+
+    @return The image, a 304 response if the browser already has it, or a 403/404 error.
+    """
+
+    MODELS_PATH = path.join(BASEDIR, *current_app.config["MODELS_PATH"])
+
+    #The same index answers for the visibility and the version, even if the run is deleted meanwhile
+    indexed_run = get_request_run(run)
+    if indexed_run is None:
+        abort(404)
+
+    public = get_image_visibility(indexed_run, filename)
+    if public is None:
+        abort(404)
+    if not (public or current_user.is_authenticated):
+        abort(403)
+
+    etag = f"{run}/{filename}"
+    immutable = True
+
+    version = indexed_run["versions"].get(filename)
+    if version is not None:
+        etag = f"{etag}/{version}"
+        immutable = request.args.get("v") == version
+
+    if not path.isdir(path.join(MODELS_PATH, run)):
+        return send_archived_image(run, filename, etag, public, immutable)
+
+    return send_model_image(f"{run}/webp", filename, etag, public, immutable)
+
+
+@main.route('/blobs/<key>/<name>')
+def model_blob(key:str, name:str):
+    """
+    The function `model_blob` serves an image of the blob store, addressed by the hash of its content.
+    The same URL is shared by all the runs where the frame is identical, so the browsers download it
+    only once. The URLs of the blobs are handed out only for the public frames and the keys cannot be
+    guessed, so the view does not check the visibility.
+
+    @param key The `key` parameter is the content address of the blob.
+    @param name The `name` parameter is the name of the image inside the blob, e.g. "frame.webp",
+    "thumb.webp" or "640w.webp".
+
+    @return The image, a 304 response if the browser already has it, or a 404 error.
+    """
+
+    if not BLOB_KEY_PATTERN.match(key) or "/" in name or not name.endswith(".webp"):
+        abort(404)
+
+    return send_model_image(f"{BLOBS_DIRNAME}/{key[:2]}/{key}", name, f"{key}/{name}", True)
+
+
+def send_model_image(directory:str, filename:str, etag:str, public:bool, immutable:bool=True) ->Response:
+    """
+    The function `send_model_image` sends an image of the models directory once it has been authorized.
+    Once published the images never change, so they are cached by the browsers as immutable and a
+    conditional request is answered with 304 without touching the file. When MODELS_SENDFILE is set the
+    transfer of the bytes is delegated to the front proxy.
+
+    @param directory The `directory` parameter is the path of the directory of the image relative to
+    MODELS_PATH, with "/" separators.
+    @param filename The `filename` parameter is the path of the image inside `directory`.
+    @param etag The `etag` parameter is the entity tag of the image.
+    @param public The `public` parameter tells if the image can be kept by the shared caches.
+    @param immutable The `immutable` parameter tells if the image can be cached as immutable.
+
+    @return The response.
+    """
+
+    MODELS_PATH = path.join(BASEDIR, *current_app.config["MODELS_PATH"])
+
+    max_age = current_app.config["MODEL_IMAGES_MAX_AGE"]
+    sendfile = current_app.config["MODELS_SENDFILE"]
+
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+    elif sendfile:
+        image_file = safe_join(MODELS_PATH, *directory.split("/"), filename)
+        if image_file is None:
+            abort(404)
+
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+        response.set_etag(etag)
+        if sendfile == "x-accel-redirect":
+            response.headers["X-Accel-Redirect"] = quote(f"{current_app.config['MODELS_SENDFILE_PREFIX'].rstrip('/')}/{directory}/{filename}")
+        elif sendfile == "x-sendfile":
+            response.headers["X-Sendfile"] = image_file
+    else:
+        response = send_from_directory(path.join(MODELS_PATH, *directory.split("/")), filename, etag=etag, max_age=max_age)
+
+    return cache_model_image(response, public, immutable)
+
+
+def send_archived_image(run:str, filename:str, etag:str, public:bool, immutable:bool=True) ->Response:
+    """
+    The function `send_archived_image` sends an image of a run packed into the archive, read with a
+    random access to its entry. It is cached by the browsers like the images of the published runs.
+
+    @param run The `run` parameter is a string that represents the run directory.
+    @param filename The `filename` parameter is the path of the image inside the webp directory of the
+    run.
+    @param etag The `etag` parameter is the entity tag of the image.
+    @param public The `public` parameter tells if the image can be kept by the shared caches.
+    @param immutable The `immutable` parameter tells if the image can be cached as immutable.
+
+    @return The response.
+    """
+
+    MODELS_PATH = path.join(BASEDIR, *current_app.config["MODELS_PATH"])
+
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+    else:
+        data = read_archived_file(MODELS_PATH, run, filename)
+        if data is None:
+            abort(404)
+
+        response = Response(data, mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+        response.set_etag(etag)
+        response.make_conditional(request, accept_ranges=True, complete_length=len(data))
+
+    return cache_model_image(response, public, immutable)
+
+
+def cache_model_image(response:Response, public:bool, immutable:bool=True) ->Response:
+    """
+    The function `cache_model_image` sets the caching headers of an image of the models directory: once
+    published the images never change, so they are immutable. The images that can change, i.e. the
+    animations requested without their current version, are revalidated by the browsers instead.
+
+    @param response The `response` parameter is the response of the image.
+    @param public The `public` parameter tells if the image can be kept by the shared caches.
+    @param immutable The `immutable` parameter tells if the image can be cached as immutable.
+
+    @return The response.
+    """
+
+    #Shared caches must not keep the images of the restricted models
+    response.cache_control.public = public
+    if not public:
+        response.cache_control.private = True
+    if immutable:
+        response.cache_control.max_age = current_app.config["MODEL_IMAGES_MAX_AGE"]
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = None
+        response.cache_control.no_cache = True
+
+    return response
+
+
+@main.route('/api/events/')
+def events():
+    """
+    The function `events` opens a server-sent events stream announcing the runs published from now on,
+    or since the Last-Event-ID sent by a reconnecting browser. Forecasters waiting for a run can keep
+    the dashboard open and have only the cards of the changed run updated.
+
+    @return A text/event-stream response, or a 503 error if too many clients are connected to this
+    process, in which case the browser retries later.
+    """
+
+    MODELS_PATH = path.join(BASEDIR, *current_app.config["MODELS_PATH"])
+
+    try:
+        last_id = int(request.headers.get("Last-Event-ID", ""))
+    except ValueError:
+        catalog.refresh(MODELS_PATH)
+        last_id = catalog.version
+
+    if not publication_feed.connect():
+        response = Response(status=503)
+        response.headers["Retry-After"] = str(current_app.config["EVENTS_HEARTBEAT_SECONDS"])
+        return response
+
+    response = Response(publication_feed.stream(last_id), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    #Let nginx pass the events as soon as they are written
+    response.headers["X-Accel-Buffering"] = "no"
+
+    return response
+
+
 @main.route('/get-archive-models/', methods = ['POST'])
 def get_archive_models():
     """
@@ -184,36 +524,44 @@ def get_archive_models():
     return jsonify(result)
 
 
-@main.route('/get-availables-date/', methods = ['POST'])
-def get_availables_date():
+@main.route('/api/available-dates/')
+def available_dates():
     """
-    The function `get_availables_date` retrieves a list of available dates from a specified directory
-    path and returns it as a JSON response.
+    The function `available_dates` returns the days with published runs, used by the datepicker of the
+    archive. The list is read from the catalog index and the response carries an ETag tied to the
+    catalog version, so it can be kept by the browsers and by the shared caches. It is revalidated at
+    every use and answered with 304 until a new run is published.
     
-    @return a JSON object. If there are no exceptions, the JSON object will have the following
-    structure:
+    @return a JSON object with the following structure:
     {
       "success": true,
-      "dirlist": "[list of available dates as a JSON string]"
+      "days": {"YYYYMMDD": ["YYYYMMDDHH", ...], ...},
+      "today": "YYYYMMDD"
     }
     """
 
     try:
-        full_models_path = path.join(BASEDIR, *current_app.config["MODELS_PATH"], "*")
-        dir_list = glob.glob(full_models_path, recursive=True)
+        MODELS_PATH = path.join(BASEDIR, *current_app.config["MODELS_PATH"])
 
-        dir_list = [path.basename(e)[:-2] for e in dir_list]
-        dir_list = list(dict.fromkeys(dir_list))
+        days = catalog.get_days(MODELS_PATH)
 
         local = convert_into_local_time('Europe/Rome', datetime.utcnow())
         day = local[1].strftime("%Y%m%d")
-        dir_list.append(day)
-        
-        json_string = json.dumps(dir_list)
-        result = {"success":True, "dirlist": json_string}
+
+        #The current day is always selectable, so it is part of the validator too
+        etag = f"{catalog.version}-{day}"
+
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = jsonify({"success":True, "days": days, "today": day})
+
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
     except Exception as e:
         jmsg = {"success":False, "value": repr(e)}
         logging.error(jmsg)
-        result = jmsg
+        response = jsonify(jmsg)
 
-    return result
\ No newline at end of file
+    return response
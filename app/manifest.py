@@ -0,0 +1,252 @@
+import json
+import logging
+import time
+from os import makedirs, path, remove, replace, scandir, stat
+
+
+MANIFESTS_DIRNAME = ".manifests"
+
+#Files that failed are retried after RETRY_BASE_SECONDS, doubled at every failure up to RETRY_MAX_SECONDS,
+#or as soon as they change (e.g. still being written)
+RETRY_BASE_SECONDS = 60
+RETRY_MAX_SECONDS = 3600
+
+
+#In-memory copy of the manifests, so that a completed run costs a single stat() per pass
+_manifests = {}
+
+
+#########################################
+# IS INGESTABLE                         #
+#########################################
+def is_ingestable(name:str) ->bool:
+    """
+    The function `is_ingestable` checks if a file delivered in a run directory has to be processed.
+
+    @param name The `name` parameter is a string that represents the file name.
+
+    @return Returns True for the PNG frames and for the map/section XML descriptors.
+    """
+
+    return name.endswith(".png") or ( name.endswith(".xml") and name.startswith(("map_", "section_")) )
+
+
+#########################################
+# IS PROCESSED                          #
+#########################################
+def is_processed(record:dict, st, now:float) ->bool:
+    """
+    The function `is_processed` checks if a file recorded in a manifest can be skipped by a pass.
+
+    @param record The `record` parameter is the manifest record of the file, or None if it is new.
+    @param st The `st` parameter is the current stat result of the file.
+    @param now The `now` parameter is the current time, in seconds since the epoch.
+
+    @return Returns True if the file has not changed and it has been processed, or it failed and its
+    retry is not due yet.
+    """
+
+    if not record or record["size"] != st.st_size or record["mtime"] != st.st_mtime_ns:
+        return False
+
+    return record["state"] == "done" or record.get("retry_at", 0) > now
+
+
+#########################################
+# LOAD MANIFEST                         #
+#########################################
+def load_manifest(models_path:str, run:str) ->dict:
+    """
+    The function `load_manifest` returns the manifest of a run directory, reading it from disk only
+    the first time.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param run The `run` parameter is a string that represents the run directory.
+
+    @return A dictionary with the run directory "mtime" seen at the last scan, the "complete" flag,
+    the "files" mapping every file name to its size, mtime and state and, once the first frame has
+    been converted, the name of the encoder "profile" of the run.
+    """
+
+    if run not in _manifests:
+        manifest = {"mtime": None, "complete": False, "files": {}}
+        try:
+            with open(path.join(models_path, MANIFESTS_DIRNAME, run + ".json")) as j:
+                manifest = json.load(j)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+            logging.error(msg)
+
+        _manifests[run] = manifest
+
+    return _manifests[run]
+
+
+#########################################
+# SAVE MANIFEST                         #
+#########################################
+def save_manifest(models_path:str, run:str, manifest:dict):
+    """
+    The function `save_manifest` persists the manifest of a run directory via temp+rename.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param run The `run` parameter is a string that represents the run directory.
+    @param manifest The `manifest` parameter is the dictionary to persist.
+    """
+
+    manifests_dir = path.join(models_path, MANIFESTS_DIRNAME)
+    if not path.exists(manifests_dir):
+        makedirs(manifests_dir)
+
+    tmp_file = path.join(manifests_dir, run + ".json.tmp")
+    with open(tmp_file, "w") as outfile:
+        json.dump(manifest, outfile)
+    replace(tmp_file, path.join(manifests_dir, run + ".json"))
+
+    _manifests[run] = manifest
+
+
+#########################################
+# REMOVE MANIFEST                       #
+#########################################
+def remove_manifest(models_path:str, run:str):
+    """
+    The function `remove_manifest` deletes the manifest of a run directory that has been removed.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param run The `run` parameter is a string that represents the run directory.
+    """
+
+    _manifests.pop(run, None)
+
+    manifest_file = path.join(models_path, MANIFESTS_DIRNAME, run + ".json")
+    if path.exists(manifest_file):
+        remove(manifest_file)
+
+
+#########################################
+# SCAN RUN                              #
+#########################################
+def scan_run(models_path:str, run:str):
+    """
+    The function `scan_run` finds the files of a run directory that are new or changed since the last
+    pass. A completed run whose directory has not been modified is skipped with a single stat().
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param run The `run` parameter is a string that represents the run directory.
+
+    @return None if the run can be skipped, otherwise a tuple with the directory mtime taken before
+    the scan and the list of the files to process, each one a dictionary with "name", "size" and
+    "mtime".
+    """
+
+    manifest = load_manifest(models_path, run)
+
+    mtime = stat(path.join(models_path, run)).st_mtime_ns
+    if manifest["complete"] and manifest["mtime"] == mtime:
+        return None
+
+    now = time.time()
+
+    files = []
+    present = set()
+    with scandir(path.join(models_path, run)) as it:
+        for entry in it:
+            if entry.is_file() and is_ingestable(entry.name):
+                st = entry.stat()
+                present.add(entry.name)
+
+                if is_processed(manifest["files"].get(entry.name), st, now):
+                    continue
+
+                files.append({"name": entry.name, "size": st.st_size, "mtime": st.st_mtime_ns})
+
+    #Failed files that are gone no longer prevent the run from being complete
+    for name in [n for n, r in manifest["files"].items() if r["state"] != "done" and n not in present]:
+        del manifest["files"][name]
+
+    return (mtime, files)
+
+
+#########################################
+# SCAN FILES                            #
+#########################################
+def scan_files(models_path:str, run:str, names:list) ->list:
+    """
+    The function `scan_files` works like `scan_run` but only checks the given files of a run, e.g. the
+    ones reported by the filesystem watcher, without listing the run directory.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param run The `run` parameter is a string that represents the run directory.
+    @param names The `names` parameter is the list of the file names to check.
+
+    @return The list of the files to process, each one a dictionary with "name", "size" and "mtime".
+    """
+
+    manifest = load_manifest(models_path, run)
+    now = time.time()
+
+    files = []
+    for name in sorted(set(names)):
+        if not is_ingestable(name):
+            continue
+
+        try:
+            st = stat(path.join(models_path, run, name))
+        except FileNotFoundError:
+            continue
+
+        if is_processed(manifest["files"].get(name), st, now):
+            continue
+
+        files.append({"name": name, "size": st.st_size, "mtime": st.st_mtime_ns})
+
+    return files
+
+
+#########################################
+# UPDATE RUN                            #
+#########################################
+def update_run(models_path:str, run:str, mtime:int, files:list, done:set):
+    """
+    The function `update_run` records the outcome of a pass in the manifest of a run directory. The
+    files that failed again without changing are retried later and later, see RETRY_BASE_SECONDS.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param run The `run` parameter is a string that represents the run directory.
+    @param mtime The `mtime` parameter is the directory mtime returned by `scan_run`. Recording the
+    value taken before the pass guarantees that files delivered meanwhile are seen by the next one.
+    It is None after `scan_files`, so that the next full scan still lists the directory.
+    @param files The `files` parameter is the list of files returned by `scan_run` or `scan_files`.
+    @param done The `done` parameter is the set of the file names processed successfully.
+    """
+
+    manifest = load_manifest(models_path, run)
+    now = time.time()
+
+    for f in files:
+        record = {"size": f["size"], "mtime": f["mtime"], "state": "done"}
+
+        if f["name"] not in done:
+            previous = manifest["files"].get(f["name"])
+            unchanged = previous and previous["size"] == f["size"] and previous["mtime"] == f["mtime"]
+
+            record["state"] = "error"
+            record["attempts"] = previous.get("attempts", 1) + 1 if unchanged and previous["state"] == "error" else 1
+            record["retry_at"] = now + min(RETRY_BASE_SECONDS * 2 ** (record["attempts"] - 1), RETRY_MAX_SECONDS)
+
+        manifest["files"][f["name"]] = record
+
+    if mtime is not None:
+        manifest["mtime"] = mtime
+    manifest["complete"] = all(r["state"] == "done" for r in manifest["files"].values())
+
+    save_manifest(models_path, run, manifest)
@@ -13,7 +13,7 @@ class Users(UserMixin, db.Model):
     id = db.Column(db.Integer(), primary_key=True, comment="Primary key of the table")
     mail = db.Column(db.String(255), nullable=False, unique=True, comment="User's email used as a unique identifier during authentication")
     password = db.Column(db.String(255), nullable=False, comment="User password encrypted with BCrypt")
-    user_actions = db.relationship("User_actions", cascade="all, delete-orphan", lazy="select", backref=db.backref("users",lazy="joined"))
+    user_actions = db.relationship("User_actions", cascade="all, delete-orphan", lazy="select", backref=db.backref("users",lazy="select"))
 
 
 class Actions(db.Model):
@@ -27,10 +27,15 @@ class Actions(db.Model):
 
 class User_actions(db.Model):
     __tablename__ = "user_actions"
-    __table_args__ = {"schema": SCHEMA, "comment": "Table of actions performed by users"}
+    #On PostgreSQL the table is also partitioned by month of datetime, see the migrations and `create_audit_partitions`
+    __table_args__ = (
+        db.Index("ix_user_actions_user_id_datetime", "user_id", "datetime"),
+        db.Index("ix_user_actions_action_id_datetime", "action_id", "datetime"),
+        {"schema": SCHEMA, "comment": "Table of actions performed by users"}
+    )
     id = db.Column(db.Integer, primary_key=True, comment="Primary key of the table")
     user_id = db.Column(db.Integer(), db.ForeignKey(Users.id), nullable=False, comment="Foreign key to the users table")
     action_id = db.Column(db.Integer(), db.ForeignKey(Actions.id), nullable=False, comment="Foreign key to the actions table")
     remote_addr = db.Column(db.String(255), nullable=True, default=None, comment="User's IP")
     http_user_agent = db.Column(db.String(255), nullable=True, default=None, comment="User's browser")
-    datetime = db.Column(db.String(25), default=datetime.now(timezone.utc).astimezone().isoformat("T", "seconds"), nullable=False, comment="Datetime")
+    datetime = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), nullable=False, comment="Datetime")
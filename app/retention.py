@@ -0,0 +1,153 @@
+import logging
+import shutil
+import time
+from datetime import datetime, timedelta
+from os import listdir, lstat, path, replace, rmdir, unlink, walk
+
+
+#Expired runs and unused blobs are hidden with a single rename and then removed in the background by
+#`purge_trash`, so the catalog never lists a run that is being deleted
+TRASH_PREFIX = ".trash_"
+
+
+#########################################
+# EXPIRED RUNS                          #
+#########################################
+def expired_runs(runs:list, now:datetime, days:int, daily_after_days:int=0) ->list:
+    """
+    The function `expired_runs` applies the retention policy by age to the run directories: the runs of
+    the last `days` days are kept and, if `daily_after_days` is set, only the 00 UTC run is kept for the
+    days older than `daily_after_days`.
+
+    @param runs The `runs` parameter is the list of the run directories, in the format "YYYYMMDDHH".
+    @param now The `now` parameter is the current date.
+    @param days The `days` parameter is the number of days kept.
+    @param daily_after_days The `daily_after_days` parameter is the number of days for which all the runs
+    are kept, 0 to keep all the runs of the `days` days.
+
+    @return The sorted list of the runs to delete.
+    """
+
+    expiration_date = ( now - timedelta(days=days) ).strftime("%Y%m%d")
+    daily_date = ( now - timedelta(days=daily_after_days) ).strftime("%Y%m%d")
+
+    expired = []
+    for run in runs:
+        if run[0:8] < expiration_date:
+            expired.append(run)
+        elif daily_after_days and run[0:8] < daily_date and run[8:10] != "00":
+            expired.append(run)
+
+    return sorted(expired)
+
+
+#########################################
+# DISK USAGE                            #
+#########################################
+def disk_usage(models_path:str) ->float:
+    """
+    The function `disk_usage` returns the usage of the filesystem of the models directory.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+
+    @return The used space, in percent.
+    """
+
+    usage = shutil.disk_usage(models_path)
+
+    return usage.used * 100 / usage.total
+
+
+#########################################
+# MOVE TO TRASH                         #
+#########################################
+def move_to_trash(models_path:str, directory:str, name:str) ->str:
+    """
+    The function `move_to_trash` hides a directory from the application with a single rename, to be
+    removed later by `purge_trash`.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param directory The `directory` parameter is the path of the directory to remove. It must be on
+    the same filesystem of the models directory.
+    @param name The `name` parameter is the name of the directory in the trash, e.g. the run.
+
+    @return The path of the directory in the trash.
+    """
+
+    #The same run may expire again after being delivered a second time
+    trash = path.join(models_path, f"{TRASH_PREFIX}{name}.{time.time_ns()}")
+    replace(directory, trash)
+
+    return trash
+
+
+#########################################
+# PURGE TRASH                           #
+#########################################
+def purge_trash(models_path:str, files_per_second:int, max_seconds:float) ->dict:
+    """
+    The function `purge_trash` removes the directories moved to the trash file by file, at no more than
+    `files_per_second` files per second and for at most `max_seconds` seconds, so that the deletion of
+    a large run does not stall the disk for the image serving. What is left is resumed by the next pass.
+
+    Only the files without other hardlinks free disk space: the files of a run shared with a blob are
+    counted as freed when the blob itself is removed.
+
+    @param models_path The `models_path` parameter is a string that represents the path to the
+    directory where the runs are stored.
+    @param files_per_second The `files_per_second` parameter is the maximum deletion rate, 0 for no limit.
+    @param max_seconds The `max_seconds` parameter is the time budget of the pass.
+
+    @return A dictionary with the number of "inodes" and "bytes" freed, the number of "files" removed,
+    of them the "links" to files still linked elsewhere, and the number of trash directories still
+    "pending".
+    """
+
+    stats = {"inodes": 0, "bytes": 0, "files": 0, "links": 0, "pending": 0}
+
+    start = time.monotonic()
+    deadline = start + max_seconds
+
+    def throttle() ->bool:
+        stats["files"] += 1
+        if files_per_second:
+            delay = stats["files"] / files_per_second - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        return time.monotonic() < deadline
+
+    trashes = sorted( item for item in listdir(models_path) if item.startswith(TRASH_PREFIX) )
+
+    for position, trash in enumerate(trashes):
+        try:
+            for root, dirs, files in walk(path.join(models_path, trash), topdown=False):
+                for name in files + dirs:
+                    entry = path.join(root, name)
+                    st = lstat(entry)
+
+                    if name in dirs:
+                        rmdir(entry)
+                    else:
+                        unlink(entry)
+
+                    if st.st_nlink <= 1 or name in dirs:
+                        stats["inodes"] += 1
+                        stats["bytes"] += st.st_blocks * 512 if hasattr(st, "st_blocks") else st.st_size
+                    else:
+                        stats["links"] += 1
+
+                    if not throttle():
+                        stats["pending"] = len(trashes) - position
+                        return stats
+
+            rmdir(path.join(models_path, trash))
+            stats["inodes"] += 1
+        except Exception as e:
+            msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)} | {trash}"
+            logging.error(msg)
+            stats["pending"] += 1
+
+    return stats
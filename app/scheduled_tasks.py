@@ -1,249 +1,701 @@
-from os import path, remove, listdir, makedirs
+from os import listdir, path, remove, makedirs, replace
 from pathlib import Path
-from PIL import Image
-from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from . import scheduler
 import logging
+import threading
+import time
 from datetime import datetime, timedelta
 import pytz
 import json
-from bs4 import BeautifulSoup as bs4
 import shutil
+from app.catalog import list_runs, publish, update_snapshots
+from app.descriptors import MAP_MARKER_ATTRIBUTES, SECTION_MARKER_ATTRIBUTES, iter_markers
+from app.manifest import load_manifest, remove_manifest, scan_files, scan_run, update_run
+from app.archive import list_archived_runs, pack_run, remove_archive
+from app.audit import create_audit_partitions
+from app.blobs import BLOBS_DIRNAME, purge_blobs, write_blob_index
+from app.retention import TRASH_PREFIX, disk_usage, expired_runs, move_to_trash, purge_trash
+from app.images import ANIMATIONS_DIRNAME, RENDITIONS_DIRNAME, build_animation, convert_png, rendition_name
+from app.watcher import Watcher
+
+
+BASEDIR = path.abspath( path.dirname(__file__) )
+
+SIZE = (600, 600)
+
+#Interval of the `process_models` job, slowed down to INGEST_SWEEP_SECONDS while the filesystem watcher runs
+PROCESS_MODELS_SECONDS = 60
+
+#Duration in milliseconds of every frame of the animated WebP
+ANIMATION_FRAME_DURATION = 500
+
+#Maximum width of the frames of the animated WebP, assembled from the renditions of this width when available
+ANIMATION_WIDTH = 1280
+
+#Outputs are written here and renamed into webp/ only when complete. It lives inside webp/ so that it is
+#on the same filesystem and does not change the mtime of the run directory tracked by the manifest
+STAGING_DIRNAME = ".staging"
+        
+MODEL_TYPES={
+    "bo08":"meteo",
+    "molita15":"meteo",
+    "ww3ita":"marino",
+    "ww3MED":"marino"
+}
+
+#WebP encoder settings per model type, see app.images.prepare_image. Compare them on a real run with
+#"flask benchmark-webp <run>" before changing them. On 12 charts of 1000x800 pixels with filled contours,
+#isolines and labels, the palette PNGs took 154.9 kB lossless against 617.8 kB at quality 80 (0.6x the
+#encode time), the same charts antialiased in RGB 1124.0 kB lossless against 498.8 kB (4.7x the time):
+#the maps are encoded losslessly only when delivered as palette PNGs
+ENCODER_PROFILES={
+    "default":{"lossless":False, "quality":80, "method":4, "alpha":"keep"},
+    "meteo":{"lossless":"palette", "quality":80, "method":4, "alpha":"keep"},
+    "marino":{"lossless":"palette", "quality":80, "method":4, "alpha":"keep"}
+}
+
+
+#The interval sweep and the filesystem watcher never ingest at the same time
+_ingest_lock = threading.Lock()
+
+#Position of the scan of the blob store, None when there is no scan in progress. A new scan is requested
+#when blobs may have lost their last link, i.e. when files of the trash are removed or runs are ingested
+_blobs_scan_cursor = ""
+_blobs_scan_requested = False
+
+#Runs with new frames, mapped to the time of their last ingestion: their animations are built by
+#`build_animations` once the run has gone quiet. None until all the runs have been checked after the start
+_pending_animations = None
+_pending_animations_lock = threading.Lock()
+
+
+def get_encoder_profile(manifest:dict, names:list) ->dict:
+    """
+    The function `get_encoder_profile` chooses the encoder profile of a run directory from the type of
+    the models described by its XML files. The profile is chosen once, when the first frames of the run
+    are converted, and recorded in its manifest, so that all the frames of a run are encoded alike: if
+    the frames are delivered before the descriptors, the run is explicitly given the default profile.
+
+    @param manifest The `manifest` parameter is the manifest of the run, see `load_manifest`.
+    @param names The `names` parameter is the list of the file names delivered in the run directory and
+    not yet recorded in the manifest.
+
+    @return The profile of the model type, or the default one if the run had no descriptor when its
+    first frames were converted or has models of different types.
+    """
+
+    name = manifest.get("profile")
+
+    if name not in ENCODER_PROFILES:
+        files = list(manifest["files"]) + names
+        types = set( MODEL_TYPES.get(n.split("_")[1], "") for n in files if n.endswith(".xml") and n.count("_") >= 1 )
+
+        name = types.pop() if len(types) == 1 and next(iter(types)) in ENCODER_PROFILES else "default"
+
+        #Recorded with the outcome of the pass by `update_run`
+        if any( n.endswith(".png") for n in names ):
+            manifest["profile"] = name
+
+    return ENCODER_PROFILES[name]
+
+
+def create_webp(dir:str, size:tuple, models_path:str, pool:ProcessPoolExecutor, pngs:list, delete_origin:bool=False, profile:dict=None) ->set:
+    """
+    The function `create_webp` takes a directory path, image size, models path, a process pool, the list
+    of the new images, and a flag to delete the original image, and converts the given PNG images to WebP
+    format in parallel, saving them in a new "webp" directory, creating thumbnails in a "thumbs"
+    subdirectory and the renditions of the RENDITION_WIDTHS widths in a "sizes" subdirectory. The outputs are
+    deduplicated across the runs through the blob store of MODELS_PATH and the key of every frame is
+    recorded in the blob index of the run. The conversion throughput is logged for every run directory.
+
+    @param dir The `dir` parameter is a string that represents the directory where the PNG images are
+    located. This directory should be a subdirectory of the `models_path` directory.
+    @param size The `size` parameter is a tuple that specifies the desired dimensions of the thumbnail
+    image. It should be in the format `(width, height)`.
+    @param models_path The `models_path` parameter is the path to the directory where the images are
+    located.
+    @param pool The `pool` parameter is the process pool that runs the conversions.
+    @param pngs The `pngs` parameter is the list of the paths of the images to be converted, i.e. the new
+    or changed images found by `scan_run`.
+    @param delete_origin The `delete_origin` parameter is a boolean flag that determines whether or not
+    to delete the original image file after converting it to WebP format. If `delete_origin` is set to
+    `True`, the original image file will be deleted. If it is set to `False` (default), the
+    @param profile The `profile` parameter is the encoder profile of the run, see `get_encoder_profile`.
+
+    @return The set of the names of the images converted successfully.
+    """
+
+    done = set()
+
+    try:
+        if not pngs:
+            return done
+
+        destination_dir = path.join(models_path, dir, "webp")
+        thumb_destination_dir = path.join(destination_dir, "thumbs")
+        renditions_dir = path.join(destination_dir, RENDITIONS_DIRNAME)
+        staging_dir = path.join(destination_dir, STAGING_DIRNAME)
+        blobs_dir = path.join(models_path, BLOBS_DIRNAME)
+
+        if not path.exists(thumb_destination_dir):
+            makedirs(thumb_destination_dir)
+        if not path.exists(renditions_dir):
+            makedirs(renditions_dir)
+        if not path.exists(staging_dir):
+            makedirs(staging_dir)
+
+        start = time.perf_counter()
+
+        futures = {}
+        for png in pngs:
+            destination = path.join(destination_dir, Path(png).stem + ".webp")
+            thumb_destination = path.join(thumb_destination_dir, "thumb_" + Path(png).stem + ".webp")
+            renditions = {w: path.join(renditions_dir, rendition_name(Path(png).stem + ".webp", w)) for w in scheduler.app.config["RENDITION_WIDTHS"]}
+
+            futures[ pool.submit(convert_png, png, destination, thumb_destination, size, staging_dir, blobs_dir, renditions, profile, delete_origin) ] = png
+
+        blobs = {}
+        for future in as_completed(futures):
+            try:
+                written, key, linked = future.result()
+                done.add( path.basename(futures[future]) )
+                if key is not None:
+                    #A frame copied from its blob does not keep the blob alive, it is served from the run
+                    blobs[ Path(futures[future]).stem + ".webp" ] = key if linked else None
+            except Exception as e:
+                msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+                logging.error(msg)
+
+        if blobs:
+            write_blob_index(destination_dir, blobs, staging_dir)
+
+        elapsed = time.perf_counter() - start
+        logging.info(f"{dir}: {len(pngs)} frames converted in {elapsed:.2f} s ({len(pngs) / elapsed:.1f} frames/s), {len(set(blobs.values()) - {None})} distinct blobs")
+    except Exception as e:
+        msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+        logging.error(msg)
+
+    return done
+
+
+def write_model_json(data:dict, webp_dir:str, model:str):
+    """
+    The function `write_model_json` publishes the JSON file of a model. The file is written in the
+    staging directory and renamed into place, so that readers find either the previous version or the
+    complete new one.
+
+    @param data The `data` parameter is the dictionary to write.
+    @param webp_dir The `webp_dir` parameter is the webp directory of the run.
+    @param model The `model` parameter is the model name, i.e. the JSON file name without extension.
+    """
+
+    staging_dir = path.join(webp_dir, STAGING_DIRNAME)
+    if not path.exists(staging_dir):
+        makedirs(staging_dir)
+
+    staged_file = path.join(staging_dir, model + ".json")
+    with open(staged_file, "w") as outfile:
+        json.dump(data, outfile, indent = 4)
+    replace(staged_file, path.join(webp_dir, model + ".json"))
+
+
+def convert_xml_section_to_json(dir:str, models_path:str, model_types:dict, xmaps:list, delete_origin:bool=False) ->set:
+    """
+    The function `convert_xml_section_to_json` converts XML files to JSON format, extracting specific
+    data and saving it in a JSON file.
+
+    @param dir The `dir` parameter is a string that represents the directory path where the XML files
+    are located.
+    @param models_path The `models_path` parameter is the path to the directory where the XML and JSON
+    files are stored.
+    @param model_types The `model_types` parameter is a dictionary that maps the model names to their
+    corresponding types. It is used to populate the "tipo" field in the JSON data.
+    @param xmaps The `xmaps` parameter is the list of the paths of the new or changed map XML files.
+    @param delete_origin The `delete_origin` parameter is a boolean flag that determines whether or not
+    to delete the original XML file after converting it to JSON. If `delete_origin` is set to `True`,
+    the original XML file will be deleted. If `delete_origin` is set to `False` (default),
+
+    @return The set of the names of the XML files converted successfully.
+    """
+
+    done = set()
+
+    for xmap in xmaps:
+        try:
+            data = {}
+
+            model = Path(xmap).stem
+            m = model.split("_")
+
+            data["nomeModello"] = m[1]
+            data["etichetta"] = model
+            data["dataEmissione"] = datetime.utcfromtimestamp( path.getmtime(xmap) ).replace(tzinfo=pytz.UTC).isoformat(sep="T", timespec="microseconds")
+            data["pubblico"] = True
+            data["tipo"] = model_types.get(m[1], "")
+            data["percorso"] = dir
+
+            data["immagini"] = list( iter_markers(xmap, MAP_MARKER_ATTRIBUTES) )
+
+            write_model_json(data, path.join( models_path, dir, "webp" ), model)
+            done.add( path.basename(xmap) )
+
+            if delete_origin:
+                if path.exists( path.join(models_path, dir, "webp", model + ".json" ) ):
+                    remove(xmap)
+        except Exception as e:
+            #A malformed descriptor must not stop the others, it is retried by the next passes
+            msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)} | {xmap}"
+            logging.error(msg)
+
+    return done
+
+
+def convert_xml_map_to_json(dir:str, models_path:str, model_types:dict, xsects:list, delete_origin:bool=False) ->set:
+    """
+    The function `convert_xml_map_to_json` converts XML map files to JSON format, saving the converted
+    files in a specified directory and optionally deleting the original XML files.
+
+    @param dir The `dir` parameter is a string that represents the directory path where the XML files
+    are located. It specifies the directory where the XML files are stored.
+    @param models_path The `models_path` parameter is the path to the directory where the XML files and
+    the JSON files will be stored.
+    @param model_types The `model_types` parameter is a dictionary that maps the model names to their
+    corresponding types. It is used to populate the "tipo" field in the JSON data.
+    @param xsects The `xsects` parameter is the list of the paths of the new or changed section XML files.
+    @param delete_origin A boolean flag indicating whether to delete the original XML file after
+    converting it to JSON. If set to True, the original XML file will be deleted. If set to False, the
+    original XML file will be retained.
+
+    @return The set of the names of the XML files converted successfully.
+    """
+
+    done = set()
+
+    for xsect in xsects:
+        try:
+            data = {}
+
+            model = Path(xsect).stem
+            m = model.split("_")
+
+            data["nomeModello"] = m[1]
+            data["etichetta"] = model
+            data["dataEmissione"] = datetime.utcfromtimestamp( path.getmtime(xsect) ).replace(tzinfo=pytz.UTC).isoformat(sep="T", timespec="microseconds")
+            data["pubblico"] = False
+            data["tipo"] = model_types.get(m[1], "")
+            data["percorso"] = dir
+
+            data["immagini"] = list( iter_markers(xsect, SECTION_MARKER_ATTRIBUTES) )
+
+            write_model_json(data, path.join( models_path, dir, "webp" ), model)
+            done.add( path.basename(xsect) )
+
+            if delete_origin:
+                if path.exists( path.join( models_path, dir, "webp", model + ".json" ) ):
+                    remove(xsect)
+        except Exception as e:
+            #A malformed descriptor must not stop the others, it is retried by the next passes
+            msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)} | {xsect}"
+            logging.error(msg)
+
+    return done
+
+
+def create_animations(dir:str, models_path:str, pool:ProcessPoolExecutor, profile:dict=None) ->int:
+    """
+    The function `create_animations` assembles the frames of every map variable (the `like` prefix) and
+    of every section of a run into an animated WebP with a JSON index of the frame timestamps. The frames
+    are ordered by their step number and the timestamp of a step is the run time plus the step times the
+    `offset` hours of the variable. Only the animations whose frames have changed are built again, from
+    the renditions of ANIMATION_WIDTH pixels when the frames are wider.
+
+    @param dir The `dir` parameter is a string that represents the run directory.
+    @param models_path The `models_path` parameter is the path to the directory where the runs are stored.
+    @param pool The `pool` parameter is the process pool that builds the animations.
+    @param profile The `profile` parameter is the encoder profile of the run.
+
+    @return The number of animations built.
+    """
+
+    built = 0
+
+    try:
+        webp_dir = path.join(models_path, dir, "webp")
+        animations_dir = path.join(webp_dir, ANIMATIONS_DIRNAME)
+        #Not the staging directory of the run, which is dropped by `ingest_runs` at the end of every pass
+        staging_dir = path.join(animations_dir, STAGING_DIRNAME)
+
+        for d in (animations_dir, staging_dir):
+            if not path.exists(d):
+                makedirs(d)
+
+        files = sorted(listdir(webp_dir))
+        frames = [f for f in files if f.endswith(".webp")]
+        run_time = datetime.strptime(dir[0:10], "%Y%m%d%H").replace(tzinfo=pytz.UTC)
+
+        variables = {}
+        for json_file in [f for f in files if f.endswith(".json") and not f.startswith(".")]:
+            with open(path.join(webp_dir, json_file)) as j:
+                jdata = json.load(j)
+
+            for img in jdata["immagini"]:
+                if json_file.startswith("map_"):
+                    variables[img["like"]] = img.get("offset")
+                elif json_file.startswith("section_"):
+                    variables[Path(img["file"]).stem] = None
+
+        futures = {}
+        for prefix, offset in variables.items():
+            steps = []
+            for position, frame in enumerate(f for f in frames if f.startswith(prefix)):
+                step = frame[len(prefix):-len(".webp")].lstrip("_")
+                steps.append( (int(step) if step.isdigit() else position, frame) )
+            steps.sort()
+
+            if len(steps) < 2:
+                continue
+
+            timestamps = []
+            for step, frame in steps:
+                try:
+                    timestamps.append( (run_time + timedelta(hours=step * float(offset))).isoformat() )
+                except (TypeError, ValueError):
+                    timestamps.append(None)
+
+            index = {"frames": [f for _, f in steps], "timestamps": timestamps, "duration": ANIMATION_FRAME_DURATION}
+
+            index_destination = path.join(animations_dir, prefix + ".json")
+            try:
+                with open(index_destination) as j:
+                    if json.load(j) == index:
+                        continue
+            except (FileNotFoundError, ValueError):
+                pass
+
+            sources = []
+            for _, frame in steps:
+                rendition = path.join(webp_dir, RENDITIONS_DIRNAME, rendition_name(frame, ANIMATION_WIDTH))
+                sources.append(rendition if path.exists(rendition) else path.join(webp_dir, frame))
+
+            futures[ pool.submit(build_animation, sources, path.join(animations_dir, prefix + ".webp"), index_destination, index, staging_dir, profile, ANIMATION_WIDTH) ] = prefix
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+                built += 1
+            except Exception as e:
+                msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)} | {dir}/{futures[future]}"
+                logging.error(msg)
+
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    except Exception as e:
+        msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+        logging.error(msg)
+
+    return built
+
+
+def ingest_runs(models_path:str, runs:dict) ->list:
+    """
+    The function `ingest_runs` converts the new or changed files of the given runs and publishes the
+    runs that have changed to the catalog index.
+
+    Within a run the images are published before the model JSON files, so a model never appears
+    before its thumbnails, and the run is announced to the web processes only once the pass on it is
+    over, so their catalog never indexes a half-converted run.
+
+    @param models_path The `models_path` parameter is the path to the directory where the runs are stored.
+    @param runs The `runs` parameter is a dictionary mapping every run directory to the list of the file
+    names to process, or to None to scan the whole directory through its manifest.
+
+    @return The list of the runs that have changed.
+    """
+
+    global _blobs_scan_requested
+
+    changed = []
+
+    with _ingest_lock:
+        #The worker processes are started only when the first conversion is submitted
+        with ProcessPoolExecutor(max_workers=scheduler.app.config["WEBP_WORKERS"] or None) as pool:
+            for dir, names in runs.items():
+
+                if names is None:
+                    #Completed runs are skipped by the manifest with a single stat()
+                    scan = scan_run(models_path, dir)
+                    if scan is None:
+                        continue
+
+                    mtime, files = scan
+                else:
+                    mtime, files = None, scan_files(models_path, dir, names)
+
+                if not files:
+                    if mtime is not None:
+                        update_run(models_path, dir, mtime, files, set())
+                    continue
+
+                names = [f["name"] for f in files]
+
+                pngs = [path.join(models_path, dir, n) for n in names if n.endswith(".png")]
+                xmaps = [path.join(models_path, dir, n) for n in names if n.startswith("map_") and n.endswith(".xml")]
+                xsects = [path.join(models_path, dir, n) for n in names if n.startswith("section_") and n.endswith(".xml")]
+
+                profile = get_encoder_profile(load_manifest(models_path, dir), names)
+
+                done = create_webp(dir, SIZE, models_path, pool, pngs, delete_origin=True, profile=profile)
+
+                done |= convert_xml_section_to_json(dir=dir, models_path=models_path, model_types=MODEL_TYPES, xmaps=xmaps, delete_origin=True)
+
+                done |= convert_xml_map_to_json(dir=dir, models_path=models_path, model_types=MODEL_TYPES, xsects=xsects, delete_origin=True)
+
+                if done and scheduler.app.config["ANIMATED_WEBP"]:
+                    with _pending_animations_lock:
+                        if _pending_animations is not None:
+                            _pending_animations[dir] = time.monotonic()
+
+                #Leftovers of failed conversions are dropped, the sources are retried through the manifest
+                shutil.rmtree(path.join(models_path, dir, "webp", STAGING_DIRNAME), ignore_errors=True)
+
+                update_run(models_path, dir, mtime, files, done)
+
+                if done:
+                    #Invalidate the catalog index of the web processes only for the run that has changed
+                    update_snapshots(models_path, [dir])
+                    publish(models_path, [dir])
+                    changed.append(dir)
+
+                    #A frame delivered again may have replaced the link to its previous blob
+                    _blobs_scan_requested = True
+
+    return changed
 
 
 @scheduler.task(
     "interval",
     id="process_models",
-    seconds=60,
+    seconds=PROCESS_MODELS_SECONDS,
     max_instances=1
 )
 def process_models():
     """
     The function `process_models` performs various tasks related to processing models, including
-    creating webp images and converting XML sections to JSON.
+    creating webp images and converting XML sections to JSON. When the filesystem watcher is enabled
+    it only acts as a reconciliation sweep for the events that have been missed.
     """
 
     try:
         with scheduler.app.app_context():
 
-            def create_webp(dir:str, size:tuple, models_path:str, ext:str="png", delete_origin:bool=False):
-                """
-                The function `create_webp` takes a directory path, image size, models path, file extension, and a
-                flag to delete the original image, and converts all PNG images in the specified directory to WebP
-                format, saving them in a new "webp" directory and creating thumbnails in a "thumbs" subdirectory.
-                
-                @param dir The `dir` parameter is a string that represents the directory where the PNG images are
-                located. This directory should be a subdirectory of the `models_path` directory.
-                @param size The `size` parameter is a tuple that specifies the desired dimensions of the thumbnail
-                image. It should be in the format `(width, height)`.
-                @param models_path The `models_path` parameter is the path to the directory where the images are
-                located.
-                @param ext The `ext` parameter is a string that specifies the file extension of the images to be
-                converted to webp format. By default, it is set to "png", but you can change it to any other image
-                file format such as "jpg" or "jpeg" if needed.
-                @param delete_origin The `delete_origin` parameter is a boolean flag that determines whether or not
-                to delete the original image file after converting it to WebP format. If `delete_origin` is set to
-                `True`, the original image file will be deleted. If it is set to `False` (default), the
-                """
-
-                try:
-                    for png in glob( path.join(models_path, dir, "*." + ext) ):
-                                
-                        destination_dir = path.join(models_path, dir, "webp")
-                        destination = path.join(destination_dir, Path(png).stem + ".webp")
-
-                        if not path.exists(destination_dir):
-                            makedirs(destination_dir)
-
-                        if not path.exists(destination): 
-                            
-                            image = Image.open(png)
-                            image.save(destination, format="webp")
-                                
-                        thumb_destination_dir = path.join(models_path, dir, "webp", "thumbs")
-                        thumb_destination = path.join(thumb_destination_dir, "thumb_" + Path(png).stem + ".webp")
-
-                        if not path.exists(thumb_destination_dir):
-                            makedirs(thumb_destination_dir)
-
-                        if not path.exists(thumb_destination): 
-                                    
-                            image = Image.open(png)
-                            image.thumbnail(size, Image.Resampling.LANCZOS)
-                            image.save(thumb_destination, format="webp")
-
-                        if delete_origin:
-                            if path.exists(destination) and path.exists(thumb_destination):
-                                remove(png) 
-                except Exception as e:
-                    msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
-                    logging.error(msg)
-
-
-            def convert_xml_section_to_json(dir:str, models_path:str, model_types:dict, delete_origin:bool=False):
-                """
-                The function `convert_xml_section_to_json` converts XML files to JSON format, extracting specific
-                data and saving it in a JSON file.
-                
-                @param dir The `dir` parameter is a string that represents the directory path where the XML files
-                are located.
-                @param models_path The `models_path` parameter is the path to the directory where the XML and JSON
-                files are stored.
-                @param model_types The `model_types` parameter is a dictionary that maps the model names to their
-                corresponding types. It is used to populate the "tipo" field in the JSON data.
-                @param delete_origin The `delete_origin` parameter is a boolean flag that determines whether or not
-                to delete the original XML file after converting it to JSON. If `delete_origin` is set to `True`,
-                the original XML file will be deleted. If `delete_origin` is set to `False` (default),
-                """
-
-                for xmap in glob( path.join(models_path, dir, "map_*.xml") ):
-                
-                    data = {}
-
-                    model = Path(xmap).stem
-                    m = model.split("_")
-
-                    data["nomeModello"] = m[1]
-                    data["etichetta"] = model
-                    data["dataEmissione"] = datetime.utcfromtimestamp( path.getmtime(xmap) ).replace(tzinfo=pytz.UTC).isoformat(sep="T", timespec="microseconds")
-                    data["pubblico"] = True
-                    data["tipo"] = model_types.get(m[1], "")
-                    data["percorso"] = dir
-
-                    images = []
-
-                    with open(xmap, "r") as f:
-
-                        fdata = f.read()
-                        Bs_data = bs4(fdata, features="xml")
-
-                        for tag in Bs_data.find_all('marker'):
-                        
-                            image = {}
-
-                            image["var"] = tag.get("var")
-                            image["title"] = tag.get("title")
-                            image["like"] = tag.get("like")
-                            image["offset"] = tag.get("offset")
-                            image["label"] = tag.get("label")
-                    
-                            images.append(image)
-
-                    data["immagini"] = images
-                            
-                    with open( path.join( models_path, dir, "webp", model + ".json" ), "w") as outfile:
-                        json.dump(data, outfile, indent = 4)
-
-                    if delete_origin:
-                        if path.exists( path.join(models_path, dir, "webp", model + ".json" ) ):
-                            remove(xmap) 
-
-
-            def convert_xml_map_to_json(dir:str, models_path:str, model_types:dict, delete_origin:bool=False):
-                """
-                The function `convert_xml_map_to_json` converts XML map files to JSON format, saving the converted
-                files in a specified directory and optionally deleting the original XML files.
-                
-                @param dir The `dir` parameter is a string that represents the directory path where the XML files
-                are located. It specifies the directory where the XML files are stored.
-                @param models_path The `models_path` parameter is the path to the directory where the XML files and
-                the JSON files will be stored.
-                @param model_types The `model_types` parameter is a dictionary that maps the model names to their
-                corresponding types. It is used to populate the "tipo" field in the JSON data.
-                @param delete_origin A boolean flag indicating whether to delete the original XML file after
-                converting it to JSON. If set to True, the original XML file will be deleted. If set to False, the
-                original XML file will be retained.
-                """
-            
-                for xsect in glob( path.join(models_path, dir, "section_*.xml") ):
-
-                    data = {}
-
-                    model = Path(xsect).stem
-                    m = model.split("_")
-
-                    data["nomeModello"] = m[1]
-                    data["etichetta"] = model
-                    data["dataEmissione"] = datetime.utcfromtimestamp( path.getmtime(xsect) ).replace(tzinfo=pytz.UTC).isoformat(sep="T", timespec="microseconds")
-                    data["pubblico"] = False
-                    data["tipo"] = model_types.get(m[1], "")
-                    data["percorso"] = dir
-
-                    images = []
-
-                    with open(xsect, "r") as f:
-
-                        fdata = f.read()
-                        Bs_data = bs4(fdata, features="xml")
-
-                        for tag in Bs_data.find_all('marker'):
-                    
-                            image = {}
-
-                            image["file"] = tag.get("file")
-                            image["lat"] = tag.get("lat")
-                            image["lon"] = tag.get("lon")
-                            image["name"] = tag.get("name")
-                            image["nick"] = tag.get("nick")
-
-                            images.append(image)
-
-                    data["immagini"] = images
-
-                    with open( path.join( models_path, dir, "webp", model + ".json" ), "w") as outfile:
-                        json.dump(data, outfile, indent = 4)
-
-                    if delete_origin:
-                        if path.exists( path.join( models_path, dir, "webp", model + ".json" ) ):
-                            remove(xsect) 
-
-                            
-            BASEDIR = path.abspath( path.dirname(__file__) )
             MODELS_PATH = path.join(BASEDIR, *scheduler.app.config["MODELS_PATH"]) 
 
-            SIZE = (600, 600)
-                    
-            MODEL_TYPES={
-                "bo08":"meteo",
-                "molita15":"meteo",
-                "ww3ita":"marino",
-                "ww3MED":"marino"
-            }
-
-            dirs = [ item for item in listdir(MODELS_PATH) if path.isdir(path.join(MODELS_PATH, item)) ]
-            for dir in dirs:
-                create_webp(dir, SIZE, MODELS_PATH, delete_origin=True)
-                             
-                convert_xml_section_to_json(dir=dir, models_path=MODELS_PATH, model_types=MODEL_TYPES, delete_origin=True)
-
-                convert_xml_map_to_json(dir=dir, models_path=MODELS_PATH, model_types=MODEL_TYPES, delete_origin=True)
+            ingest_runs(MODELS_PATH, dict.fromkeys( list_runs(MODELS_PATH) ))
     except Exception as e:
         msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
         logging.error(msg)
 
 
+@scheduler.task(
+    "interval",
+    id="build_animations",
+    seconds=PROCESS_MODELS_SECONDS,
+    max_instances=1
+)
+def build_animations():
+    """
+    The function `build_animations` builds the animated WebP of the runs that have received no new file
+    for ANIMATION_QUIET_SECONDS seconds, so that a run delivered frame by frame is animated once when its
+    delivery is over, instead of at every ingested batch. After a start all the runs are checked once,
+    and only the animations whose frames have changed are built.
+    """
+
+    global _pending_animations
+
+    if not scheduler.app.config["ANIMATED_WEBP"]:
+        return
+
+    try:
+        with scheduler.app.app_context():
+
+            MODELS_PATH = path.join(BASEDIR, *scheduler.app.config["MODELS_PATH"])
+            quiet = scheduler.app.config["ANIMATION_QUIET_SECONDS"]
+
+            now = time.monotonic()
+            with _pending_animations_lock:
+                if _pending_animations is None:
+                    _pending_animations = dict.fromkeys(list_runs(MODELS_PATH), now - quiet)
+
+                runs = [run for run, last in _pending_animations.items() if now - last >= quiet]
+                for run in runs:
+                    del _pending_animations[run]
+
+            if not runs:
+                return
+
+            with ProcessPoolExecutor(max_workers=scheduler.app.config["WEBP_WORKERS"] or None) as pool:
+                for dir in runs:
+                    if not path.isdir(path.join(MODELS_PATH, dir, "webp")):
+                        continue
+
+                    profile = get_encoder_profile(load_manifest(MODELS_PATH, dir), [])
+
+                    if create_animations(dir, MODELS_PATH, pool, profile):
+                        publish(MODELS_PATH, [dir])
+    except Exception as e:
+        msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+        logging.error(msg)
+
+
+def start_watcher():
+    """
+    The function `start_watcher` starts the filesystem watcher that ingests the files as soon as they are
+    written under MODELS_PATH, and slows down the `process_models` interval to a reconciliation sweep.
+    If the watcher stops because of an error, the original interval is restored. It has to be called
+    only by the process elected as scheduler leader.
+    """
+
+    app = scheduler.app
+    MODELS_PATH = path.join(BASEDIR, *app.config["MODELS_PATH"]) 
+
+    def ingest_events(runs:dict):
+        with app.app_context():
+            ingest_runs(MODELS_PATH, runs)
+
+    def restore_sweep():
+        #Without the watcher the interval job is again the only way the models are ingested
+        logging.error(f"Filesystem watcher stopped: models are ingested by the interval job every {PROCESS_MODELS_SECONDS} s")
+        scheduler.scheduler.reschedule_job("process_models", trigger="interval", seconds=PROCESS_MODELS_SECONDS)
+
+    watcher = Watcher(MODELS_PATH, ingest_events, delay=app.config["INGEST_WATCHER_DELAY"], on_stop=restore_sweep)
+    if not watcher.supported:
+        logging.warning("Filesystem watcher not supported on this platform: models are ingested by the interval job only")
+        return
+
+    watcher.start()
+    scheduler.scheduler.reschedule_job("process_models", trigger="interval", seconds=app.config["INGEST_SWEEP_SECONDS"])
+
+
 @scheduler.task(
     "interval",
     id="delete_old_models",
-    days=1,
+    minutes=10,
     max_instances=1
 )
 def delete_old_models():
     """
+    The function `delete_old_models` applies the retention policies to the runs: the runs older than
+    RETENTION_DAYS days are deleted, only the 00 UTC run is kept beyond RETENTION_DAILY_AFTER_DAYS days
+    and, while the disk usage is above RETENTION_DISK_HIGH_WATER, the oldest run is deleted too.
+
+    When ARCHIVE_DAYS is set, the runs expired by age are packed into the archive before being deleted
+    and stay browsable until they are ARCHIVE_DAYS days old. Under disk pressure the archives go first.
+
+    The deleted runs and the blobs no longer linked by any run are hidden at once and then removed
+    incrementally by `purge_trash`, at a limited rate and within a time budget, so that the deletion
+    does not stall the image serving. The blob store is scanned for the unused blobs only after files
+    have been removed or runs ingested, within a time budget too. The inodes and the bytes freed are
+    logged at every pass.
     """
 
+    global _blobs_scan_cursor, _blobs_scan_requested
+
     try:
         with scheduler.app.app_context():
 
-            BASEDIR = path.abspath( path.dirname(__file__) )
-            MODELS_PATH = path.join(BASEDIR, *scheduler.app.config["MODELS_PATH"]) 
+            config = scheduler.app.config
+            MODELS_PATH = path.join(BASEDIR, *config["MODELS_PATH"]) 
+
+            now = datetime.utcnow()
+            runs = list_runs(MODELS_PATH)
+            expired = expired_runs(runs, now, config["RETENTION_DAYS"], config["RETENTION_DAILY_AFTER_DAYS"])
+
+            archive_days = config["ARCHIVE_DAYS"]
+            archived = list_archived_runs(MODELS_PATH)
+            expired_archives = expired_runs(archived, now, archive_days)
+
+            #The space of the runs already deleted is freed only once the trash is empty
+            high_water = config["RETENTION_DISK_HIGH_WATER"]
+            pending = any( item.startswith(TRASH_PREFIX) for item in listdir(MODELS_PATH) )
+            if high_water and not pending and disk_usage(MODELS_PATH) > high_water:
+                #One run per pass, never one of the latest day
+                candidates = [r for r in archived if r not in expired_archives] + [r for r in runs if r not in expired and r[0:8] < runs[-1][0:8]]
+                if candidates:
+                    logging.warning(f"Disk usage above {high_water}%: deleting the run {candidates[0]}")
+                    if candidates[0] in archived:
+                        expired_archives.append(candidates[0])
+                    else:
+                        expired.append(candidates[0])
+
+            deleted = []
+
+            for dir in expired_archives:
+                remove_archive(MODELS_PATH, dir)
+                deleted.append(dir)
+
+            to_archive = expired_runs(runs, now, config["RETENTION_DAYS"]) if archive_days > config["RETENTION_DAYS"] else []
+            for dir in expired:
+                if dir in to_archive and dir not in expired_runs([dir], now, archive_days):
+                    try:
+                        size = pack_run(MODELS_PATH, dir)
+                        logging.info(f"{dir}: archived in {size / 1024 / 1024:.1f} MB")
+                    except Exception as e:
+                        #The run is kept and packed again at the next pass
+                        msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)} | {dir}"
+                        logging.error(msg)
+                        continue
+
+                #The run is first hidden with a single rename, then removed by purge_trash
+                move_to_trash(MODELS_PATH, path.join(MODELS_PATH, dir), dir)
+                remove_manifest(MODELS_PATH, dir)
+                deleted.append(dir)
+
+            if deleted:
+                update_snapshots(MODELS_PATH, deleted)
+                publish(MODELS_PATH, deleted)
+
+            stats = purge_trash(MODELS_PATH, config["RETENTION_PURGE_FILES_PER_SECOND"], config["RETENTION_PURGE_MAX_SECONDS"])
+
+            #The links removed by this pass may have been the last ones to some blobs
+            if stats["links"]:
+                _blobs_scan_requested = True
+
+            #A request made while a scan is in progress starts a new scan once it is complete
+            if _blobs_scan_cursor is None and _blobs_scan_requested:
+                _blobs_scan_requested = False
+                _blobs_scan_cursor = ""
+
+            purged = 0
+            if _blobs_scan_cursor is not None:
+                #A blob is linked by its run only after being stored, so it is never purged during an ingestion
+                purged, _blobs_scan_cursor = purge_blobs(MODELS_PATH, _ingest_lock, config["RETENTION_BLOBS_SCAN_MAX_SECONDS"], _blobs_scan_cursor)
+
+            if deleted or purged or stats["files"]:
+                logging.info(f"Retention: {len(deleted)} runs and {purged} unused blobs deleted, {stats['inodes']} inodes and {stats['bytes'] / 1024 / 1024:.1f} MB freed, {stats['pending']} directories pending")
+    except Exception as e:
+        msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+        logging.error(msg)
 
-            expiration_date = ( datetime.now() - timedelta(days=8) ).strftime("%Y%m%d")
+@scheduler.task(
+    "interval",
+    id="create_audit_partitions",
+    hours=24,
+    max_instances=1
+)
+def create_audit_partitions_task():
+    """
+    The function `create_audit_partitions_task` creates in advance the monthly partitions of the
+    user_actions table for the next AUDIT_PARTITION_MONTHS_AHEAD months.
+    """
+
+    try:
+        with scheduler.app.app_context():
 
-            dirs = [ item for item in listdir(MODELS_PATH) if path.isdir(path.join(MODELS_PATH, item)) ]
-            for dir in dirs:
-                if dir[0:8] < expiration_date:
-                    shutil.rmtree(path.join(MODELS_PATH, dir), ignore_errors=True)
+            config = scheduler.app.config
+
+            created = create_audit_partitions(config["PROJECT_NAME"], config["AUDIT_PARTITION_MONTHS_AHEAD"])
+            if created:
+                logging.info(f"Audit partitions created: {', '.join(created)}")
     except Exception as e:
         msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
-        logging.error(msg)
\ No newline at end of file
+        logging.error(msg)
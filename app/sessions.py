@@ -0,0 +1,226 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from os import path
+from cachelib.file import FileSystemCache
+from flask import Flask, Request, Response
+from flask.json.tag import TaggedJSONSerializer
+from flask_session.sessions import ServerSideSession, SessionInterface
+from itsdangerous import BadSignature, want_bytes
+
+
+class SqliteSession(ServerSideSession):
+    pass
+
+
+class SqliteSessionInterface(SessionInterface):
+    """
+    It's a server-side session interface storing the sessions in a local SQLite database,
+    shared by all the web server workers of the host.
+
+    The database runs in WAL mode with synchronous=NORMAL, so a write appends to the log
+    without an fsync. A session is written only when it is modified or when its expiry
+    has to be extended by more than SESSION_REFRESH_SECONDS, and the expired sessions are
+    removed with a single indexed DELETE every SESSION_SWEEP_SECONDS.
+
+    The sessions of the filesystem backend are migrated lazily: an unknown session id is
+    looked up in SESSION_FILE_DIR and moved to the database on first use.
+    """
+
+    session_class = SqliteSession
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self):
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__last_sweep = 0
+        self.__legacy = None
+        self.database = None
+        self.legacy_dir = None
+        self.key_prefix = "session:"
+        self.use_signer = False
+        self.permanent = True
+        self.refresh_seconds = 0
+        self.sweep_seconds = 0
+
+
+    def init_app(self, app:Flask):
+        """
+        The function `init_app` creates the sessions database, if needed, and installs the interface
+        in the application.
+
+        @param app The `app` parameter is the Flask application object.
+        """
+
+        self.database = path.join(app.instance_path, app.config["SESSION_SQLITE_FILE"])
+        self.legacy_dir = app.config.get("SESSION_FILE_DIR") or path.join(os.getcwd(), "flask_session")
+        self.key_prefix = app.config.get("SESSION_KEY_PREFIX", "session:")
+        self.use_signer = app.config.get("SESSION_USE_SIGNER", False)
+        self.permanent = app.config.get("SESSION_PERMANENT", True)
+        self.refresh_seconds = app.config["SESSION_REFRESH_SECONDS"]
+        self.sweep_seconds = app.config["SESSION_SWEEP_SECONDS"]
+        self.has_same_site_capability = hasattr(self, "get_cookie_samesite")
+
+        #The connections are opened by every thread on first use, never before the workers are forked
+        connection = sqlite3.connect(self.database, timeout=5)
+        try:
+            with connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, data TEXT NOT NULL, expiry INTEGER NOT NULL) WITHOUT ROWID")
+                connection.execute("CREATE INDEX IF NOT EXISTS sessions_expiry ON sessions (expiry)")
+        finally:
+            connection.close()
+
+        app.session_interface = self
+
+
+    def open_session(self, app:Flask, request:Request) ->SqliteSession:
+        """
+        The function `open_session` loads the session of the request, if it exists and it has not
+        expired.
+
+        @param app The `app` parameter is the Flask application object.
+        @param request The `request` parameter is the current request.
+
+        @return The session, empty with a new id if the request has no valid session.
+        """
+
+        #The new sessions are left empty, the permanent flag is set only when they are stored: Flask-Login
+        #marks every non empty session as not fresh, which would write the session of every visitor
+        sid = request.cookies.get(app.config["SESSION_COOKIE_NAME"])
+        if not sid:
+            return self.session_class(sid=self._generate_sid())
+
+        if self.use_signer:
+            signer = self._get_signer(app)
+            if signer is None:
+                return None
+            try:
+                sid = signer.unsign(sid).decode()
+            except BadSignature:
+                return self.session_class(sid=self._generate_sid())
+
+        now = int(time.time())
+
+        try:
+            row = self.__connect().execute("SELECT data, expiry FROM sessions WHERE sid = ? AND expiry > ?", (sid, now)).fetchone()
+        except Exception as e:
+            msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+            logging.error(msg)
+            row = None
+
+        if row is not None:
+            try:
+                session = self.session_class(self.serializer.loads(row[0]), sid=sid)
+                session.expiry = row[1]
+                return session
+            except Exception as e:
+                msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+                logging.error(msg)
+
+        data = self.__pop_legacy(sid)
+        if data is not None:
+            #Marked as modified, so that it is written to the database at the end of the request
+            session = self.session_class(data, sid=sid)
+            session.modified = True
+            return session
+
+        return self.session_class(sid=sid)
+
+
+    def save_session(self, app:Flask, session:SqliteSession, response:Response):
+        """
+        The function `save_session` writes the session to the database and sends its cookie, only if the
+        session has been modified or its expiry has to be extended. An emptied session is deleted.
+
+        @param app The `app` parameter is the Flask application object.
+        @param session The `session` parameter is the session of the request.
+        @param response The `response` parameter is the response of the request.
+        """
+
+        domain = self.get_cookie_domain(app)
+        cookie_path = self.get_cookie_path(app)
+        now = int(time.time())
+
+        self.__sweep(now)
+
+        if not session:
+            if session.modified:
+                with self.__connect() as connection:
+                    connection.execute("DELETE FROM sessions WHERE sid = ?", (session.sid,))
+                response.delete_cookie(app.config["SESSION_COOKIE_NAME"], domain=domain, path=cookie_path)
+            return
+
+        expiry = now + int(app.permanent_session_lifetime.total_seconds())
+        stored = getattr(session, "expiry", None)
+        if not session.modified and (stored is None or expiry - stored < self.refresh_seconds):
+            return
+
+        if self.permanent:
+            session.permanent = True
+
+        with self.__connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO sessions (sid, data, expiry) VALUES (?, ?, ?)", (session.sid, self.serializer.dumps(dict(session)), expiry))
+
+        conditional_cookie_kwargs = {}
+        if self.has_same_site_capability:
+            conditional_cookie_kwargs["samesite"] = self.get_cookie_samesite(app)
+
+        if self.use_signer:
+            session_id = self._get_signer(app).sign(want_bytes(session.sid))
+        else:
+            session_id = session.sid
+
+        response.set_cookie(app.config["SESSION_COOKIE_NAME"], session_id,
+                            expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=cookie_path, secure=self.get_cookie_secure(app),
+                            **conditional_cookie_kwargs)
+
+
+    def __connect(self) ->sqlite3.Connection:
+        connection = getattr(self.__local, "connection", None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.database, timeout=5)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.__local.connection = connection
+
+        return connection
+
+
+    def __sweep(self, now:int):
+        with self.__lock:
+            if now - self.__last_sweep < self.sweep_seconds:
+                return
+            self.__last_sweep = now
+
+        try:
+            with self.__connect() as connection:
+                connection.execute("DELETE FROM sessions WHERE expiry <= ?", (now,))
+        except Exception as e:
+            msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+            logging.error(msg)
+
+
+    def __pop_legacy(self, sid:str):
+        if not path.isdir(self.legacy_dir):
+            return None
+
+        try:
+            if self.__legacy is None:
+                self.__legacy = FileSystemCache(self.legacy_dir, threshold=0)
+
+            data = self.__legacy.get(self.key_prefix + sid)
+            if data is not None:
+                self.__legacy.delete(self.key_prefix + sid)
+
+            return data
+        except Exception as e:
+            msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+            logging.error(msg)
+            return None
+
+
+sqlite_sessions = SqliteSessionInterface()
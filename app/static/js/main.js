@@ -84,18 +84,54 @@
 	}) ;
 
 
+	/**
+	 * The CSRF token of the login form is requested only when the login modal is opened, so that the
+	 * pages of the anonymous users do not need a session and can be cached.
+	 */
+	$("#login-modal").on("show.bs.modal", function(){
+		$.ajax({
+			type: "GET",
+			url : (base_href == "/") ? "/api/csrf-token/" : base_href + "/api/csrf-token/",
+			dataType: "json",
+			cache: false,
+			success: function(r) {
+				if(r.success){
+					$("#csrf_token").val(r.value) ;
+				}
+			},
+			error: function(error){
+				console.log(error) ;
+			}
+		}) ;
+	}) ;
+
+
 	/** 
-	 * The code is making an AJAX POST request to the "get-availables-date" endpoint with the `async`
-	 * option set to `false`, which means the request will be synchronous. The response from the request
-	 * is stored in the `data` variable. 
+	 * The days with published runs are loaded asynchronously from the "api/available-dates" endpoint, so
+	 * the datepicker is shown immediately and refreshed as soon as they arrive. The response is cached
+	 * by the browser and revalidated with its ETag.
 	 */
-	const data = $.ajax({
-		type: "POST",
-		url : (base_href == "/") ? "/get-availables-date/" : base_href + "/get-availables-date/",
-		async:false
-	}).responseText ;
+	let available_days = {} ;
+	let today = "" ;
 
-	const dirlist = JSON.parse(data).dirlist ;
+	const load_available_days = () => {
+		$.ajax({
+			type: "GET",
+			url : (base_href == "/") ? "/api/available-dates/" : base_href + "/api/available-dates/",
+			dataType: "json",
+			success: function(r) {
+				if(r.success){
+					available_days = r.days ;
+					today = r.today ;
+					$("#datepicker").datepicker("refresh") ;
+				}
+			},
+			error: function(error){
+				console.log(error) ;
+			}
+		}) ;
+	} ;
+	load_available_days() ;
 
 	const options = $.extend({
 		onSelect: function(){ 
@@ -110,7 +146,7 @@
 
 				var string = jQuery.datepicker.formatDate('yymmdd', date) ;
 
-				if(dirlist.indexOf(string) == -1){
+				if(!available_days.hasOwnProperty(string) && string != today){
 					return [false, ""] ;
 				} else{
 					return [true, ""] ;
@@ -141,4 +177,46 @@
     	models_run_checkbox( $(this)) ;
   	}) ;
 
+
+	/**
+	 * The function `update_run_cards` downloads the dashboard again and replaces only the cards of a run
+	 * that has been published. The page is reloaded if the run is new or has been removed, so that the
+	 * sidebar is updated too.
+	 * 
+	 * @param run The parameter `run` is the run directory, in the format "YYYYMMDDHH".
+	 */
+	const update_run_cards = (run) => {
+		$.get(window.location.href, function(html){
+			const cards = $("<div>").append( $.parseHTML(html) ).find("#content [data-id=" + run + "]") ;
+			const current = $("#content [data-id=" + run + "]") ;
+
+			if(cards.length == 0 || current.length == 0){
+				window.location.reload() ;
+				return ;
+			}
+
+			current.first().before(cards) ;
+			current.remove() ;
+		}) ;
+	} ;
+
+
+	/**
+	 * On the dashboard, the page listens to the "api/events" server-sent events and updates the cards of
+	 * the runs of the displayed day as soon as they are published, instead of being refreshed by hand.
+	 */
+	const dashboard_day = window.location.pathname.match(/(\d{8})\/?$/) ;
+
+	if(dashboard_day && window.EventSource){
+		const source = new EventSource( (base_href == "/") ? "/api/events/" : base_href + "/api/events/" ) ;
+
+		source.addEventListener("published", function(e){
+			const event = JSON.parse(e.data) ;
+
+			load_available_days() ;
+
+			event.runs.filter(run => run.startsWith(dashboard_day[1])).forEach(run => update_run_cards(run)) ;
+		}) ;
+	}
+
 })(jQuery) ;
@@ -0,0 +1,160 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from os import path
+from app.catalog import list_runs
+from app.manifest import is_ingestable
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+#The root is watched for new run directories, the runs for files completely written or moved in
+ROOT_MASK = IN_CREATE | IN_MOVED_TO | IN_ONLYDIR
+RUN_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.inotify_init1
+    _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+except (OSError, AttributeError, TypeError):
+    _libc = None
+
+
+class Watcher(threading.Thread):
+    """
+    It's a thread that listens to the inotify events under MODELS_PATH and passes the affected files,
+    grouped by run, to a callback. Events are collected until no new one arrives for `delay` seconds,
+    so that a run delivering hundreds of frames is ingested in a few batches. If the thread stops
+    because of an error, `on_stop` is called so that the caller can fall back to polling.
+    """
+
+    def __init__(self, models_path:str, callback, delay:float=2, on_stop=None):
+        super().__init__(name="models-watcher", daemon=True)
+        self.__models_path = models_path
+        self.__callback = callback
+        self.__delay = delay
+        self.__on_stop = on_stop
+        self.__fd = None
+        self.__wds = {}
+
+
+    @property
+    def supported(self) ->bool:
+        """
+        It returns True if inotify is available on the current platform.
+
+        @return A boolean.
+        """
+
+        return _libc is not None
+
+
+    def run(self):
+        """
+        The function `run` is the main loop of the thread. If the watcher stops because of an error, the
+        inotify descriptor is closed and `on_stop` is called.
+        """
+
+        try:
+            self.__fd = _libc.inotify_init1(IN_CLOEXEC)
+            if self.__fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1")
+
+            self.__add_watch(self.__models_path, None, ROOT_MASK)
+            for run in list_runs(self.__models_path):
+                self.__add_watch(path.join(self.__models_path, run), run, RUN_MASK)
+
+            pending = {}
+            first_event = None
+
+            while True:
+                timeout = self.__delay if pending else None
+                ready, _, _ = select.select([self.__fd], [], [], timeout)
+
+                if ready:
+                    if not pending:
+                        first_event = time.monotonic()
+                    self.__read_events(pending)
+
+                #Dispatch after a quiet period, or anyway every few periods during a long delivery
+                if pending and (not ready or time.monotonic() - first_event > 5 * self.__delay):
+                    runs, pending = pending, {}
+                    self.__dispatch(runs)
+        except Exception as e:
+            msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+            logging.error(msg)
+
+        if self.__fd is not None and self.__fd >= 0:
+            os.close(self.__fd)
+        self.__fd = None
+        self.__wds = {}
+
+        if self.__on_stop is not None:
+            try:
+                self.__on_stop()
+            except Exception as e:
+                msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+                logging.error(msg)
+
+
+    def __add_watch(self, directory:str, run:str, mask:int):
+        wd = _libc.inotify_add_watch(self.__fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch", directory)
+        self.__wds[wd] = run
+
+
+    def __read_events(self, pending:dict):
+        data = os.read(self.__fd, 64 * 1024)
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode( data[offset + EVENT_HEADER.size : offset + EVENT_HEADER.size + length].rstrip(b"\0") )
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                #Some events are lost: every run is rescanned through its manifest
+                for run in list_runs(self.__models_path):
+                    pending[run] = None
+                continue
+
+            if mask & IN_IGNORED:
+                self.__wds.pop(wd, None)
+                continue
+
+            if wd not in self.__wds:
+                continue
+
+            run = self.__wds[wd]
+
+            if run is None:
+                if mask & IN_ISDIR and not name.startswith("."):
+                    #Files written before the watch was added are found by a full scan of the new run
+                    self.__add_watch(path.join(self.__models_path, name), name, RUN_MASK)
+                    pending[name] = None
+            elif is_ingestable(name) and pending.get(run, ()) is not None:
+                pending.setdefault(run, set()).add(name)
+
+
+    def __dispatch(self, runs:dict):
+        try:
+            self.__callback(runs)
+        except Exception as e:
+            msg = f"{ __file__} | Line {e.__traceback__.tb_lineno} | {repr(e)}"
+            logging.error(msg)
@@ -69,14 +69,53 @@ class Config(object):
     APP_PORT = "4040"
     APP_SSL_CONTEXT = ["./certs/server.crt", "./certs/server.key"]
     JSON_SORT_KEYS = False
-    SESSION_TYPE = 'filesystem'
+    SESSION_TYPE = getenv("SESSION_TYPE") or 'sqlite'
     SESSION_PERMANENT = True
-    SESSION_FILE_THRESHOLD = 1
+    SESSION_FILE_THRESHOLD = 500
+    SESSION_SQLITE_FILE = "sessions.db"
+    SESSION_REFRESH_SECONDS = 300
+    SESSION_SWEEP_SECONDS = 600
+    IDENTITY_CACHE_SECONDS = 300
+    AUDIT_BATCH_SIZE = 100
+    AUDIT_FLUSH_SECONDS = 2
+    AUDIT_QUEUE_SIZE = 10000
+    AUDIT_PARTITION_MONTHS_AHEAD = 3
+    BCRYPT_ROUNDS = int(getenv("BCRYPT_ROUNDS") or 12)
+    LOGIN_VERIFY_WORKERS = 1
+    LOGIN_VERIFY_QUEUE = 8
+    LOGIN_VERIFY_TIMEOUT = 10
+    LOGIN_RATE_WINDOW = 300
+    LOGIN_RATE_LIMIT_IP = 20
+    LOGIN_RATE_LIMIT_ACCOUNT = 5
+    TRUSTED_PROXIES = int(getenv("TRUSTED_PROXIES") or 0)
     PERMANENT_SESSION_LIFETIME = timedelta(hours=2)
     ADMIN_NAME = getenv('ADMIN_NAME')
     ADMIN_MAIL = getenv('ADMIN_MAIL')
     MAIL_USE_TLS = True
     SCHEDULER_API_ENABLED = True
+    SCHEDULER_AUTOSTART = (getenv("SCHEDULER_AUTOSTART") or "true").lower() != "false"
+    SCHEDULER_LOCK_FILE = "scheduler.lock"
+    WEBP_WORKERS = int(getenv("WEBP_WORKERS") or 0)
+    INGEST_WATCHER = (getenv("INGEST_WATCHER") or "false").lower() == "true"
+    INGEST_WATCHER_DELAY = 2
+    INGEST_SWEEP_SECONDS = 600
+    RENDITION_WIDTHS = tuple( int(w) for w in (getenv("RENDITION_WIDTHS") or "320,640,1280").split(",") if w.strip() )
+    ANIMATED_WEBP = (getenv("ANIMATED_WEBP") or "false").lower() == "true"
+    ANIMATION_QUIET_SECONDS = 300
+    RETENTION_DAYS = int(getenv("RETENTION_DAYS") or 8)
+    RETENTION_DAILY_AFTER_DAYS = int(getenv("RETENTION_DAILY_AFTER_DAYS") or 0)
+    RETENTION_DISK_HIGH_WATER = int(getenv("RETENTION_DISK_HIGH_WATER") or 0)
+    RETENTION_PURGE_FILES_PER_SECOND = int(getenv("RETENTION_PURGE_FILES_PER_SECOND") or 500)
+    RETENTION_PURGE_MAX_SECONDS = 240
+    RETENTION_BLOBS_SCAN_MAX_SECONDS = 30
+    ARCHIVE_DAYS = int(getenv("ARCHIVE_DAYS") or 0)
+    MODEL_IMAGES_MAX_AGE = 31536000
+    FRAGMENT_CACHE_BYTES = 32 * 1024 * 1024
+    EVENTS_POLL_SECONDS = 1
+    EVENTS_HEARTBEAT_SECONDS = 15
+    EVENTS_MAX_CLIENTS = int(getenv("EVENTS_MAX_CLIENTS") or 48)
+    MODELS_SENDFILE = (getenv("MODELS_SENDFILE") or "").lower()
+    MODELS_SENDFILE_PREFIX = getenv("MODELS_SENDFILE_PREFIX") or "/protected-models"
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_ENGINE_OPTIONS = {
         "pool_pre_ping": True,
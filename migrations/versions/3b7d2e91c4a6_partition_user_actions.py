@@ -0,0 +1,105 @@
+"""Timestamp, index and partition the user actions.
+
+Revision ID: 3b7d2e91c4a6
+Revises: 55cfdeb73bb9
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from datetime import date, datetime, timezone
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b7d2e91c4a6'
+down_revision = '55cfdeb73bb9'
+branch_labels = None
+depends_on = None
+
+
+SCHEMA = 'cmi_charts'
+MONTHS_AHEAD = 3
+
+
+def create_partitions(start:date, end:date):
+    # Monthly partitions from the month of `start` to the month of `end`, both included. The bounds are in UTC,
+    # whatever the time zone of the session
+    month = date(start.year, start.month, 1)
+    while month <= end:
+        following = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+        op.execute(f"CREATE TABLE {SCHEMA}.user_actions_y{month.year}m{month.month:02d} PARTITION OF {SCHEMA}.user_actions FOR VALUES FROM ('{month} 00:00+00') TO ('{following} 00:00+00')")
+        month = following
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    if bind.dialect.name == 'postgresql':
+        # The table is rebuilt as partitioned by month, the ids go on with the same sequence
+        op.execute(f"ALTER TABLE {SCHEMA}.user_actions RENAME TO user_actions_legacy")
+        op.execute(f"ALTER TABLE {SCHEMA}.user_actions_legacy RENAME CONSTRAINT user_actions_pkey TO user_actions_legacy_pkey")
+        op.execute(f"""
+            CREATE TABLE {SCHEMA}.user_actions (
+                id INTEGER NOT NULL DEFAULT nextval('{SCHEMA}.user_actions_id_seq'),
+                user_id INTEGER NOT NULL REFERENCES {SCHEMA}.users (id),
+                action_id INTEGER NOT NULL REFERENCES {SCHEMA}.actions (id),
+                remote_addr VARCHAR(255),
+                http_user_agent VARCHAR(255),
+                datetime TIMESTAMP WITH TIME ZONE NOT NULL,
+                PRIMARY KEY (id, datetime)
+            ) PARTITION BY RANGE (datetime)
+        """)
+        op.execute(f"COMMENT ON TABLE {SCHEMA}.user_actions IS 'Tabella delle azioni effettuate degli utenti'")
+        op.execute(f"COMMENT ON COLUMN {SCHEMA}.user_actions.datetime IS 'Data ed orario'")
+
+        first = bind.execute(sa.text(f"SELECT (min(datetime::timestamptz) AT TIME ZONE 'UTC')::date FROM {SCHEMA}.user_actions_legacy")).scalar()
+        today = datetime.now(timezone.utc).date()
+        create_partitions(min(first or today, today), date(today.year + (today.month - 1 + MONTHS_AHEAD) // 12, (today.month - 1 + MONTHS_AHEAD) % 12 + 1, 1))
+        op.execute(f"CREATE TABLE {SCHEMA}.user_actions_default PARTITION OF {SCHEMA}.user_actions DEFAULT")
+
+        op.execute(f"""
+            INSERT INTO {SCHEMA}.user_actions (id, user_id, action_id, remote_addr, http_user_agent, datetime)
+            SELECT id, user_id, action_id, remote_addr, http_user_agent, datetime::timestamptz FROM {SCHEMA}.user_actions_legacy
+        """)
+        op.execute(f"ALTER SEQUENCE {SCHEMA}.user_actions_id_seq OWNED BY {SCHEMA}.user_actions.id")
+        op.execute(f"DROP TABLE {SCHEMA}.user_actions_legacy")
+
+    op.create_index('ix_user_actions_user_id_datetime', 'user_actions', ['user_id', 'datetime'], unique=False, schema=SCHEMA)
+    op.create_index('ix_user_actions_action_id_datetime', 'user_actions', ['action_id', 'datetime'], unique=False, schema=SCHEMA)
+
+    if bind.dialect.name == 'sqlite':
+        # The column keeps its affinity, the ISO strings with offset are rewritten in UTC in the format of the DateTime
+        # type, so that the old and the new rows sort and compare alike. The schema is the database file itself attached
+        # again, the rows are written through the main one, like the version of Alembic, not to lock the file
+        op.execute(f"UPDATE main.user_actions SET datetime = strftime('%Y-%m-%d %H:%M:%f000', datetime) WHERE datetime LIKE '____-__-__T%'")
+
+
+def downgrade():
+    bind = op.get_bind()
+
+    op.drop_index('ix_user_actions_action_id_datetime', table_name='user_actions', schema=SCHEMA)
+    op.drop_index('ix_user_actions_user_id_datetime', table_name='user_actions', schema=SCHEMA)
+
+    if bind.dialect.name == 'postgresql':
+        op.execute(f"ALTER TABLE {SCHEMA}.user_actions RENAME TO user_actions_partitioned")
+        op.execute(f"ALTER TABLE {SCHEMA}.user_actions_partitioned RENAME CONSTRAINT user_actions_pkey TO user_actions_partitioned_pkey")
+        op.execute(f"""
+            CREATE TABLE {SCHEMA}.user_actions (
+                id INTEGER NOT NULL DEFAULT nextval('{SCHEMA}.user_actions_id_seq') PRIMARY KEY,
+                user_id INTEGER NOT NULL REFERENCES {SCHEMA}.users (id),
+                action_id INTEGER NOT NULL REFERENCES {SCHEMA}.actions (id),
+                remote_addr VARCHAR(255),
+                http_user_agent VARCHAR(255),
+                datetime VARCHAR(25) NOT NULL
+            )
+        """)
+        op.execute(f"""
+            INSERT INTO {SCHEMA}.user_actions (id, user_id, action_id, remote_addr, http_user_agent, datetime)
+            SELECT id, user_id, action_id, remote_addr, http_user_agent, to_char(datetime AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS"+00:00"') FROM {SCHEMA}.user_actions_partitioned
+        """)
+        op.execute(f"ALTER SEQUENCE {SCHEMA}.user_actions_id_seq OWNED BY {SCHEMA}.user_actions.id")
+        op.execute(f"DROP TABLE {SCHEMA}.user_actions_partitioned")
+
+    if bind.dialect.name == 'sqlite':
+        # Back to the ISO strings of the String column, in UTC
+        op.execute(f"UPDATE main.user_actions SET datetime = strftime('%Y-%m-%dT%H:%M:%S+00:00', datetime) WHERE datetime NOT LIKE '____-__-__T%'")
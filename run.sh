@@ -3,7 +3,8 @@
 help () {
     echo $1
     echo \"werkzeug\" for development environment.
-    echo \"gunicorn\" for development/production environment with "gunicorn" web server.
+    echo \"gunicorn\" for development/production environment with "gunicorn" web server \(set GUNICORN_THREADS to change the threads per worker, default 64\).
+    echo \"scheduler\" to run the scheduled tasks in a dedicated process \(start the web server with SCHEDULER_AUTOSTART=false\).
     echo \"help\" to show this message.
 }
 
@@ -75,7 +76,16 @@ check_env () {
 
     if [ "$ENV" == "gunicorn" ]
         then
-            gunicorn -w 4 run:app
+            #Threaded workers, so that the browsers listening for new runs do not take a whole worker each.
+            #Every open event stream still holds one thread: with 4 workers, 64 threads and EVENTS_MAX_CLIENTS=48
+            #the host accepts 192 streams and every worker keeps 16 threads for the pages and the images.
+            #Raise GUNICORN_THREADS together with EVENTS_MAX_CLIENTS, never the latter alone
+            gunicorn -w 4 -k gthread --threads ${GUNICORN_THREADS:-64} run:app
+    fi
+
+    if [ "$ENV" == "scheduler" ]
+        then
+            flask --app run run-scheduler
     fi
 
     exit 0
@@ -104,5 +114,9 @@ if [ "$1" == "gunicorn" ]; then
     check_env "gunicorn"
 fi
 
+if [ "$1" == "scheduler" ]; then
+    check_env "scheduler"
+fi
+
 help "Unrecognized parameter(s)."
 exit 0